@@ -5,9 +5,17 @@ import itertools
 import numpy
 import plot_functions
 
+from acfttrace import FULL_PRECISION
+from conflict_index import DEFAULT_MARGIN
+from pair_pruning import DEFAULT_SEGMENT_SIZE, prune_pairs, segment_mask
 from data_reducer import DataReducer
+from histograms import update_histograms
 from logreader import parse_logfile
-from tools import m2nm, nm2m, rad2deg, deg2rad, normalized
+from xmltree_reader import read_xml
+from tools import m2nm, nm2m, ft2m, rad2deg, deg2rad, normalized
+
+# The vertical minimum of the 3-D separation checks
+PZ_HEIGHT = ft2m(1000.0)
 
 
 def create_position_vector(acft):
@@ -16,11 +24,8 @@ def create_position_vector(acft):
                                acft.column('posy')))
 
 
-def create_velocity_vector(acft):
-    '''Create an array of Vx,Vy coordinates'''
-
-    tas = acft.column('tas')
-    psi = acft.column('psi')
+def velocity_components(tas, psi):
+    '''Create an array of Vx,Vy coordinates from the speeds and headings'''
 
     Vx = tas * numpy.cos(psi)
     Vy = tas * numpy.sin(psi)
@@ -28,6 +33,12 @@ def create_velocity_vector(acft):
     return numpy.column_stack((Vx, Vy))
 
 
+def create_velocity_vector(acft):
+    '''Create an array of Vx,Vy coordinates'''
+
+    return velocity_components(acft.column('tas'), acft.column('psi'))
+
+
 def create_sel_velocity_vector(acft):
     '''Create an array of commanded Vx,Vy coordinates'''
 
@@ -73,6 +84,12 @@ def calculate_distance(acft1, acft2):
     return distance
 
 
+def calculate_vertical_separation(acft1, acft2):
+    '''Calculate the altitude difference between both aircraft, from the
+    geodetic altitude (posz is the ECEF z coordinate)'''
+    return numpy.absolute(acft2.column('alt') - acft1.column('alt'))
+
+
 def calculate_future_cpa(acft1, acft2):
     rel_pos = calculate_relative_position(acft1, acft2)
     rel_vel = calculate_relative_velocity(acft1, acft2)
@@ -100,11 +117,82 @@ def calculate_path_deviation(acft):
     return path_deviation
 
 
-def collect_stats(aircraft):
-    '''Get the basic set of data required for further calculations'''
+def calculate_masked(calculate, acft1, acft2, mask=None):
+    '''Calculate a per sample value of a pair only where mask is set, it is
+    infinite elsewhere'''
+    if mask is None:
+        return calculate(acft1, acft2)
+
+    indices = numpy.flatnonzero(mask)
+
+    values = numpy.empty(acft1.n_points())
+    values.fill(numpy.inf)
+
+    values[indices] = calculate(acft1.view(indices), acft2.view(indices))
+
+    return values
+
+
+def collect_stats(aircraft, policy=None, event_index=None,
+                  margin=DEFAULT_MARGIN, cutoff=None,
+                  segment_size=DEFAULT_SEGMENT_SIZE, pz_height=None):
+    '''Get the basic set of data required for further calculations
+
+    The distance and cpa of each pair are stored in the pair dtype of the
+    storage policy, by default the policy of the aircraft. The memory of the
+    pairs is checked against the budget of the policy before any pair is
+    calculated.
+
+    With an event index (see conflict_index) only the pairs with events are
+    calculated, and only within the windows of their events padded by
+    margin seconds. The distance is infinite outside the windows, so these
+    statistics go to check_actual_los and check_conflicts directly instead
+    of through check_relevant_pairs.
+
+    With a cutoff the pairs are first pruned by the bounding boxes of
+    segments of their traces (see pair_pruning). Pairs that never come
+    within the cutoff are left out and the distance is only calculated in
+    the segments where a pair can come within the cutoff, it is infinite in
+    the others. The relevant pairs for that cutoff are the same as without
+    pruning.
+
+    With a pz_height the distance and cpa are only calculated where the
+    aircraft are vertically closer than pz_height, they are infinite where
+    the aircraft are vertically separated. Pairs that are vertically
+    separated all the time are left out, they are found with the altitude
+    bands of the segments before any per sample work.
+    '''
+    if policy is None:
+        policy = aircraft[0].policy if aircraft else FULL_PRECISION
+
+    if cutoff is None and pz_height is None:
+        pairs = [(acft1, acft2, None)
+                 for (acft1, acft2) in itertools.combinations(aircraft, 2)]
+    else:
+        (pairs, report) = prune_pairs(
+            aircraft, numpy.inf if cutoff is None else cutoff,
+            segment_size, pz_height)
+
+        print('Pruned {n_rejected} of {n_pairs} pairs ({pair_rejection:.1%}, '
+              '{n_vertical_rejected} by altitude) and {n_segments_rejected} '
+              'of {n_segments} pair segments ({segment_rejection:.1%})'
+              .format(**report))
+
+    if event_index is not None:
+        pairs = [(acft1, acft2, segments)
+                 for (acft1, acft2, segments) in pairs
+                 if event_index.has_pair(acft1.callsign, acft2.callsign)]
+
+    n_pairs_points = sum(acft1.n_points() for (acft1, _, _) in pairs)
+    n_points = sum(acft.n_points() for acft in aircraft)
+
+    policy.check_memory(n_pairs_points * policy.bytes_per_pair_point()
+                        + n_points * policy.bytes_per_state(),
+                        'The statistics of {} aircraft'.format(len(aircraft)))
+
     statistics = []
 
-    for (acft1, acft2) in itertools.combinations(aircraft, 2):
+    for (acft1, acft2, segments) in pairs:
         print('Calculating stats for {} and {}'
               .format(acft1.callsign, acft2.callsign))
 
@@ -113,8 +201,34 @@ def collect_stats(aircraft):
         pair_stats['acft1'] = acft1
         pair_stats['acft2'] = acft2
 
-        pair_stats['distance'] = calculate_distance(acft1, acft2)
-        pair_stats['cpa'] = calculate_future_cpa(acft1, acft2)
+        # The samples where the distance and cpa are needed
+        distance_mask = None
+        cpa_mask = None
+
+        if event_index is not None:
+            cpa_mask = event_index.mask(acft1.callsign, acft2.callsign,
+                                        acft1.column('t'), margin)
+            distance_mask = cpa_mask
+
+        if segments is not None:
+            in_segments = segment_mask(segments, acft1.n_points(),
+                                       segment_size)
+            distance_mask = (in_segments if distance_mask is None
+                             else distance_mask & in_segments)
+
+        if pz_height is not None:
+            vertical = calculate_vertical_separation(acft1, acft2) < pz_height
+
+            distance_mask = (vertical if distance_mask is None
+                             else distance_mask & vertical)
+            cpa_mask = vertical if cpa_mask is None else cpa_mask & vertical
+
+        distance = calculate_masked(calculate_distance, acft1, acft2,
+                                    distance_mask)
+        cpa = calculate_masked(calculate_future_cpa, acft1, acft2, cpa_mask)
+
+        pair_stats['distance'] = distance.astype(policy.pair_dtype, copy=False)
+        pair_stats['cpa'] = cpa.astype(policy.pair_dtype, copy=False)
 
         statistics.append(pair_stats)
 
@@ -123,15 +237,40 @@ def collect_stats(aircraft):
     return statistics
 
 
-def check_actual_los(statistics, pz_radius):
-    '''Check which pairs get into a LOS'''
+def _event_pairs(statistics, event_index, margin, pz_height=None):
+    '''The pairs of the statistics together with the samples that are
+    checked, the samples inside the windows of their events if there is an
+    event index and where they are vertically closer than pz_height if it is
+    given'''
+    for pair in statistics:
+        (acft1, acft2) = (pair['acft1'], pair['acft2'])
+
+        if event_index is None:
+            checked = numpy.ones(len(pair['distance']), dtype=bool)
+        elif event_index.has_pair(acft1.callsign, acft2.callsign):
+            checked = event_index.mask(acft1.callsign, acft2.callsign,
+                                       acft1.column('t'), margin)
+        else:
+            continue
+
+        if pz_height is not None:
+            checked &= calculate_vertical_separation(acft1, acft2) < pz_height
+
+        yield (pair, checked)
+
+
+def check_actual_los(statistics, pz_radius, event_index=None,
+                     margin=DEFAULT_MARGIN, pz_height=None):
+    '''Check which pairs get into a LOS, only within the windows of the
+    events of a LOS index if it is given. With a pz_height (e.g. PZ_HEIGHT)
+    a LOS also needs the aircraft to be vertically closer than pz_height'''
 
     los_collection = [{'acft1': pair['acft1'].callsign,
                        'acft2': pair['acft2'].callsign,
-                       'time': pair['acft1'].column('t')[pair['distance'] < pz_radius],
-                       'cpa': pair['distance'].min()}
-                      for pair in statistics
-                      if (pair['distance'] < pz_radius).any()]
+                       'time': pair['acft1'].column('t')[in_window & (pair['distance'] < pz_radius)],
+                       'cpa': pair['distance'][in_window].min()}
+                      for (pair, in_window) in _event_pairs(statistics, event_index, margin, pz_height)
+                      if (in_window & (pair['distance'] < pz_radius)).any()]
 
     print
     for los in los_collection:
@@ -143,15 +282,20 @@ def check_actual_los(statistics, pz_radius):
     return los_collection
 
 
-def check_conflicts(statistics, pz_radius):
-    '''Check for conflicts between aircraft pairs'''
+def check_conflicts(statistics, pz_radius, event_index=None,
+                    margin=DEFAULT_MARGIN, pz_height=None):
+    '''Check for conflicts between aircraft pairs, only within the windows
+    of the events of a conflict index if it is given. With a pz_height a
+    conflict also needs the aircraft to be vertically closer than pz_height
+    at the same sample, only the current vertical separation is tested and
+    the vertical rates are ignored'''
 
     conflict_collection = [{'acft1': pair['acft1'].callsign,
                             'acft2': pair['acft2'].callsign,
-                            'time': pair['acft1'].column('t')[pair['cpa'] < pz_radius],
-                            'cpa': pair['cpa'].min()}
-                           for pair in statistics
-                           if (pair['cpa'] < pz_radius).any()]
+                            'time': pair['acft1'].column('t')[in_window & (pair['cpa'] < pz_radius)],
+                            'cpa': pair['cpa'][in_window].min()}
+                           for (pair, in_window) in _event_pairs(statistics, event_index, margin, pz_height)
+                           if (in_window & (pair['cpa'] < pz_radius)).any()]
 
     print
     for conflict in conflict_collection:
@@ -178,11 +322,15 @@ def has_overlap(pair1, pair2, cutoff):
     return ((pair1['distance'] < cutoff) & (pair2['distance'] < cutoff)).any()
 
 
-def group_pairs(relevant_pairs, cutoff):
-    '''Group pairs that belong together'''
+def group_pairs(relevant_pairs, cutoff, event_index=None):
+    '''Group pairs that belong together, only the pairs with events are
+    grouped if an event index is given'''
 
     # Create a copy that we can play with
-    the_pairs = list(relevant_pairs)
+    the_pairs = [pair for pair in relevant_pairs
+                 if event_index is None
+                 or event_index.has_pair(pair['acft1'].callsign,
+                                         pair['acft2'].callsign)]
 
     print 'Grouping, starting with {} pairs'.format(len(the_pairs))
 
@@ -199,14 +347,17 @@ def group_pairs(relevant_pairs, cutoff):
 
             if first_pair['acft1'] == pair['acft1'] and has_overlap(first_pair, pair, cutoff):
 
-                the_pairs.remove(pair)
                 group.append(pair)
 
             elif first_pair['acft2'] == pair['acft1'] and has_overlap(first_pair, pair, cutoff):
 
-                the_pairs.remove(pair)
                 group.append(pair)
 
+        # Remove the grouped pairs by identity, comparing the dictionaries
+        # would compare the arrays inside them
+        the_pairs = [pair for pair in the_pairs
+                     if not any(pair is grouped for grouped in group)]
+
         groups.append(group)
 
     print
@@ -220,11 +371,21 @@ def group_pairs(relevant_pairs, cutoff):
     return groups
 
 
-def write_groups(groups, aircraft):
-    '''Write an xml file for each group'''
+def write_groups(groups, aircraft, n_workers=1, method='stride',
+                 output_format='xml', output_prefix='output/group',
+                 stride=10, submit=None):
+    '''Write an output file for each group, use more than one worker to
+    export the groups in parallel. The method is either 'stride' for a fixed
+    stride or 'adaptive' for an error bounded reduction. The output format is
+    one of 'xml', 'xml.gz' or 'npz'. The file of a group is the output
+    prefix followed by the group number. If submit is given, the groups are
+    only reduced here and each data_reducer._write_reduced task is handed to
+    submit, e.g. to write them in a pool of the caller.'''
 
     data_reducer = DataReducer(aircraft)
 
+    jobs = []
+
     for idx, group in enumerate(groups):
         callsigns = []
         for pair in group:
@@ -236,16 +397,32 @@ def write_groups(groups, aircraft):
 
         t_begin = group[0]['acft1'].t(0)
         t_end = group[0]['acft1'].t(-1)
-        stride = 10
 
         reduction_parameters = {
             'callsigns': callsigns,
             't_begin': t_begin,
             't_end': t_end,
-            'stride': stride}
+            'stride': stride,
+            'method': method}
+
+        jobs.append((reduction_parameters,
+                     output_prefix + str(idx + 1) + '.' + output_format))
 
+    if submit is not None:
+        for task in data_reducer.reduced_tasks(jobs, output_format):
+            submit(task)
+
+        return []
+
+    if n_workers > 1:
+        return data_reducer.write_data_parallel(jobs, n_workers,
+                                                output_format)
+
+    for (reduction_parameters, filename) in jobs:
         print
-        data_reducer.write_data(reduction_parameters, 'output/group' + str(idx + 1) + '.xml')
+        data_reducer.write_data(reduction_parameters, filename, output_format)
+
+    return []
 
 
 def clamp_heading(hdg):
@@ -296,7 +473,7 @@ def calculate_largest_cmd_state_change(acft):
     return state_change
 
 
-def per_aircraft_calculations(aircraft):
+def per_aircraft_calculations(aircraft, do_plot=True):
     '''Calculate stuff for each acft'''
 
     path_deviation = []
@@ -314,31 +491,66 @@ def per_aircraft_calculations(aircraft):
         cmd_change.append(cmd)
         state_change.append(state)
 
-    do_plot = True
-
     if do_plot:
         plot_functions.plot_path_deviation(path_deviation)
         plot_functions.plot_largest_cmd_change(cmd_change)
         # plot_functions.plot_largest_cmd_state_change(state_change)
 
+    return (path_deviation, cmd_change, state_change)
+
 
-def calculate_stats(aircraft):
-    '''Function that dispatches all stats calculations'''
+def analyse_run(aircraft, cutoff=nm2m(20.0), pz_radius=nm2m(5.0),
+                pz_height=None, do_plot=False):
+    '''Run the per aircraft calculations and the pair checks of a run
 
-    per_aircraft_calculations(aircraft)
+    Returns a dictionary with the path_deviation, cmd_change and
+    state_change of the aircraft, the relevant_pairs for the cutoff and the
+    los and conflicts for pz_radius, in 3-D with a pz_height.
+    '''
+    (path_deviation, cmd_change, state_change) = per_aircraft_calculations(
+        aircraft, do_plot)
     print
 
-    statistics = collect_stats(aircraft)
+    statistics = collect_stats(aircraft, cutoff=cutoff, pz_height=pz_height)
+
+    relevant_pairs = check_relevant_pairs(statistics, cutoff)
 
-    relevant_pairs = check_relevant_pairs(statistics, nm2m(20.0))
+    los_data = check_actual_los(relevant_pairs, pz_radius,
+                                pz_height=pz_height)
+    conflict_data = check_conflicts(relevant_pairs, pz_radius,
+                                    pz_height=pz_height)
 
-    # groups = group_pairs(relevant_pairs,nm2m(20.0))
+    return {'path_deviation' : path_deviation,
+            'cmd_change'     : cmd_change,
+            'state_change'   : state_change,
+            'relevant_pairs' : relevant_pairs,
+            'los'            : los_data,
+            'conflicts'      : conflict_data}
+
+
+def calculate_stats(aircraft, plot_dir=None, histograms=None,
+                    pz_height=None):
+    '''Function that dispatches all stats calculations, the plots are saved
+    to plot_dir instead of shown if it is given. The results are added to
+    histograms (see histograms.create_histograms) if it is given. With a
+    pz_height (e.g. PZ_HEIGHT) the LOS and conflicts are checked in 3-D.'''
+
+    if plot_dir is not None:
+        plot_functions.use_headless(plot_dir)
+
+    results = analyse_run(aircraft, pz_height=pz_height, do_plot=True)
+
+    # groups = group_pairs(results['relevant_pairs'],nm2m(20.0))
 
     # write_groups(groups, aircraft)
 
+    los_data = results['los']
+    conflict_data = results['conflicts']
 
-    los_data = check_actual_los(relevant_pairs, nm2m(5.0))
-    conflict_data = check_conflicts(relevant_pairs, nm2m(5.0))
+    if histograms is not None:
+        update_histograms(histograms, results['path_deviation'],
+                          results['cmd_change'], results['state_change'],
+                          los_data, conflict_data)
 
     do_plot = False
 
@@ -365,8 +577,12 @@ def main():
         print('Too many arguments provided!')
         sys.exit(1)
 
-    # Read the data and calculate the stats
-    aircraft = parse_logfile(filename)
+    # Read the data and calculate the stats, archived MVIEW records can be
+    # used instead of a log file
+    if filename.endswith(('.xml', '.xml.gz')):
+        aircraft = read_xml(filename)
+    else:
+        aircraft = parse_logfile(filename)
 
     calculate_stats(aircraft)
 
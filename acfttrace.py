@@ -2,36 +2,173 @@
 
 import numpy
 
+from tools import convert_unit
+
 class AircraftState:
     '''The aircraft state at a specific time point'''
 
     def __init__(self, state):
 
-        (self.t, self.posx, self.posy, self.posz,
+        (self.t, self.posx, self.posy, self.posz, self.alt,
          self.psi, self.tas, self.cas,
          self.sel_hdg, self.sel_spd, self.nd_range, self.nd_mode) = state
 
     def state_array(self):
         '''Return the state as an array'''
-        return [self.t, self.posx, self.posy, self.posz,
+        return [self.t, self.posx, self.posy, self.posz, self.alt,
                 self.psi, self.tas, self.cas, 
                 self.sel_hdg, self.sel_spd, self.nd_range, self.nd_mode]
         
 
+# The positions are ECEF coordinates, alt is the geodetic altitude
+VARIABLE_NAMES = ['t', 'posx', 'posy', 'posz', 'alt',
+                  'psi', 'tas', 'cas',
+                  'sel_hdg', 'sel_spd', 'nd_range', 'nd_mode']
+
+POSITION_NAMES = ['posx', 'posy', 'posz']
+
+class StoragePolicy:
+    '''How the states of a trace are stored in memory
+
+    The states are kept in a record array with a dtype per variable.
+    Positions are stored relative to an origin, so they keep their precision
+    in a small float type. Columns are always read back as float64 with the
+    origin added, calculations on them are done in full precision. The pair
+    dtype is used for the per pair arrays of the statistics. If a memory
+    budget (bytes) is set, check_memory raises a MemoryError before a large
+    allocation that would not fit.
+    '''
+
+    def __init__(self, dtypes=None, origin=(0.0, 0.0, 0.0),
+                 pair_dtype=numpy.float64, memory_budget=None):
+        self.dtypes        = dict((name, numpy.float64)
+                                  for name in VARIABLE_NAMES)
+        self.dtypes.update(dtypes or {})
+        self.origin        = origin
+        self.pair_dtype    = pair_dtype
+        self.memory_budget = memory_budget
+
+        self.record_dtype  = numpy.dtype([(name, self.dtypes[name])
+                                          for name in VARIABLE_NAMES])
+
+    def with_origin(self, origin):
+        '''A copy of this policy with another origin'''
+        return StoragePolicy(self.dtypes, origin, self.pair_dtype,
+                             self.memory_budget)
+
+    def __origin(self, name):
+        '''The origin of a variable, zero if it is not a position'''
+        if name in POSITION_NAMES and self.origin is not None:
+            return self.origin[POSITION_NAMES.index(name)]
+
+        return 0.0
+
+    def bytes_per_state(self):
+        '''The memory used by a single state'''
+        return self.record_dtype.itemsize
+
+    def bytes_per_pair_point(self):
+        '''The memory used by the distance and cpa of a pair at one point'''
+        return 2 * numpy.dtype(self.pair_dtype).itemsize
+
+    def check_memory(self, n_bytes, what):
+        '''Raise a MemoryError if n_bytes do not fit in the budget'''
+        if self.memory_budget is not None and n_bytes > self.memory_budget:
+            raise MemoryError(
+                '{} needs {:.1f} MB, the memory budget is {:.1f} MB'.format(
+                    what, n_bytes / 1e6, self.memory_budget / 1e6))
+
+    def pack(self, states):
+        '''Convert an array with a row per state into a record array'''
+        states = numpy.asarray(states, dtype=numpy.float64)
+        states = states.reshape(-1, len(VARIABLE_NAMES))
+
+        data = numpy.empty(len(states), dtype=self.record_dtype)
+
+        for (idx, name) in enumerate(VARIABLE_NAMES):
+            origin     = self.__origin(name)
+            data[name] = states[:, idx] - origin if origin else states[:, idx]
+
+        return data
+
+    def column(self, data, name, indices=None):
+        '''Read a column as float64, optionally only at some indices'''
+        values = data[name] if indices is None else data[name][indices]
+        values = numpy.array(values, dtype=numpy.float64)
+
+        if self.__origin(name):
+            values += self.__origin(name)
+
+        return values
+
+    def unpack(self, data, indices=None):
+        '''Convert a record array back into an array with a row per state'''
+        return numpy.column_stack([self.column(data, name, indices)
+                                   for name in VARIABLE_NAMES])
+
+    def row(self, data, idx):
+        '''Read a single state as a float64 array'''
+        return numpy.array([self.column(data, name, idx)
+                            for name in VARIABLE_NAMES])
+
+# Full precision, the default
+FULL_PRECISION = StoragePolicy()
+
+def compact_policy(origin=None, memory_budget=None):
+    '''A policy with float32 positions relative to the origin, float32
+    states and small integers for the navigation display settings. Without
+    an origin the first position that is read becomes the origin.'''
+    dtypes = dict((name, numpy.float32) for name in VARIABLE_NAMES)
+    dtypes.update({'t'        : numpy.float64,
+                   'nd_range' : numpy.int16,
+                   'nd_mode'  : numpy.int8})
+
+    return StoragePolicy(dtypes, origin, numpy.float32, memory_budget)
+
+
 class AircraftTrace:
     '''A collection of aircraft states'''
 
-    VARIABLE_NAMES = ['t', 'posx', 'posy', 'posz',
-                      'psi', 'tas', 'cas',
-                      'sel_hdg', 'sel_spd', 'nd_range', 'nd_mode']
+    VARIABLE_NAMES = VARIABLE_NAMES
 
     VARIABLE_MAP = { var:idx for (idx, var) in enumerate(VARIABLE_NAMES) }
+
+    VARIABLE_UNITS = { 't'       : 's',
+                       'posx'    : 'm',
+                       'posy'    : 'm',
+                       'posz'    : 'm',
+                       'alt'     : 'm',
+                       'psi'     : 'rad',
+                       'tas'     : 'm/s',
+                       'cas'     : 'm/s',
+                       'sel_hdg' : 'rad',
+                       'sel_spd' : 'm/s',
+                       'nd_range': None,
+                       'nd_mode' : None }
     
-    def __init__(self, callsign):
+    def __init__(self, callsign, policy=FULL_PRECISION):
 
-        self.callsign = callsign
-        self.__data   = []
+        self.callsign  = callsign
+        self.policy    = policy
+        self.__data    = []
+        self.__columns = {}
 
+    @classmethod
+    def from_data(cls, callsign, data, policy=FULL_PRECISION):
+        '''Create a finalized trace from an array of states'''
+        trace = cls(callsign, policy)
+        trace.__data = policy.pack(data)
+
+        return trace
+
+    @classmethod
+    def from_records(cls, callsign, records, policy=FULL_PRECISION):
+        '''Create a finalized trace from a record array packed by the
+        policy'''
+        trace = cls(callsign, policy)
+        trace.__data = records
+
+        return trace
 
     def __add_state_array(self, state_array):
         '''Append an array to the state'''
@@ -39,7 +176,8 @@ class AircraftTrace:
 
     def __iter__(self):
         '''Return an iterator for the data'''
-        return iter(self.__data)
+        return (self.policy.row(self.__data, idx)
+                for idx in range(len(self.__data)))
 
     def addDataPoint(self, t, state):
         '''Add a data point'''
@@ -51,26 +189,166 @@ class AircraftTrace:
 
     def finalize(self):
         '''Convert the list of states into a numpy array'''
-        self.__data = numpy.array(self.__data)
+        self.__data    = self.policy.pack(self.__data)
+        self.__columns = {}
 
     def reduce(self, reduced_indices):
         '''Reduce the data set to the specified range'''
-        self.__data = self.__data[reduced_indices]
+        # A new cache, the views on the old data keep the old one
+        self.__data    = self.__data[reduced_indices]
+        self.__columns = {}
+
+    def column(self, name, unit=None):
+        '''Get a column by name, optionally converted to another unit
 
-    def column(self, name):
-        '''Get a column by name'''
-        column_idx = self.VARIABLE_MAP[name]
+        Converted columns are cached until the trace is reduced and are
+        returned read-only. The views of the trace share the cache.
+        '''
+        if unit is None or unit == self.VARIABLE_UNITS[name]:
+            return self.policy.column(self.__data, name)
 
-        return numpy.array(self.__data[:,column_idx])
+        return _cached_column(self.__columns, name, unit,
+                              lambda: self.policy.column(self.__data, name))
 
     def t(self, idx):
         '''Get the time of a specific state'''
-        return numpy.array(self.__data[idx,0])
+        return numpy.array(self.__data['t'][idx], dtype=numpy.float64)
     
     def state(self, idx):
         '''Get the aircraft state at an index'''
-        return AircraftState(self.__data[idx])
+        return AircraftState(self.policy.row(self.__data, idx))
+
+    def n_points(self):
+        '''The size of the data'''
+        return len(self.__data)
+
+    def nbytes(self):
+        '''The memory used by the states'''
+        return self.__data.nbytes
+
+    def view(self, indices=None):
+        '''Get a lightweight view on a subset of the states'''
+        return AircraftTraceView(self.callsign, self.__data, indices,
+                                 self.policy, self.__columns)
+
+
+def _cached_column(cache, name, unit, get_column):
+    '''Get a converted column from a cache, or convert and store it'''
+    if (name, unit) not in cache:
+        converted = numpy.array(
+            convert_unit(get_column(), AircraftTrace.VARIABLE_UNITS[name],
+                         unit))
+        converted.flags.writeable = False
+
+        cache[(name, unit)] = converted
+
+    return cache[(name, unit)]
+
+
+class AircraftTraceView:
+    '''A read-only selection of an aircraft trace
+
+    The view keeps a reference to the data of the trace together with the
+    selected indices and a position offset. Values are only gathered when
+    a column or state is requested, so no full copy of the trace is made.
+    Converted columns without an offset are taken from trace_columns, the
+    cache of converted columns of the trace, so every view of a trace uses
+    the same conversion.
+    '''
+
+    def __init__(self, callsign, data, indices=None, policy=FULL_PRECISION,
+                 trace_columns=None):
+
+        self.callsign  = callsign
+        self.policy    = policy
+        self.__data    = data
+        self.__indices = (numpy.arange(len(data)) if indices is None
+                          else numpy.asarray(indices))
+        self.__offset  = numpy.zeros(len(AircraftTrace.VARIABLE_NAMES))
+        self.__columns = {}
+        self.__trace_columns = {} if trace_columns is None else trace_columns
+
+    def __iter__(self):
+        '''Return an iterator for the selected data'''
+        return (self.__offset_state(self.policy.row(self.__data, idx))
+                for idx in self.__indices)
+
+    def __offset_state(self, state_array):
+        '''Apply the position offset to a state array'''
+        return state_array + self.__offset
+
+    def reduce(self, reduced_indices):
+        '''Reduce the view further, indices are relative to the view'''
+        self.__indices = self.__indices[reduced_indices]
+        self.__columns = {}
+
+    def materialize(self):
+        '''Copy the selected states into a new, independent trace
+
+        With an offset the positions are stored relative to the shifted
+        origin, so they keep the precision of the view.
+        '''
+        policy = self.policy
+
+        if self.__offset.any():
+            origin = numpy.zeros(len(POSITION_NAMES))
+
+            if policy.origin is not None:
+                origin += policy.origin
+
+            origin += self.__offset[[AircraftTrace.VARIABLE_MAP[name]
+                                     for name in POSITION_NAMES]]
+            policy  = policy.with_origin(tuple(origin))
+
+        return AircraftTrace.from_data(
+            self.callsign,
+            self.policy.unpack(self.__data, self.__indices) + self.__offset,
+            policy)
+
+    def set_offset(self, posx=0.0, posy=0.0):
+        '''Set the offset that is added to the positions'''
+        self.__offset[AircraftTrace.VARIABLE_MAP['posx']] = posx
+        self.__offset[AircraftTrace.VARIABLE_MAP['posy']] = posy
+        self.__columns = {}
+
+    def column(self, name, unit=None):
+        '''Get a column by name, optionally converted to another unit
+
+        Converted columns are returned read-only. Columns with an offset
+        are cached until the view is reduced or shifted, the others are
+        selected from the converted column of the whole trace.
+        '''
+        if unit is None or unit == AircraftTrace.VARIABLE_UNITS[name]:
+            return self.__column(name)
+
+        if self.__offset[AircraftTrace.VARIABLE_MAP[name]]:
+            return _cached_column(self.__columns, name, unit,
+                                  lambda: self.__column(name))
+
+        converted = _cached_column(
+            self.__trace_columns, name, unit,
+            lambda: self.policy.column(self.__data, name))[self.__indices]
+        converted.flags.writeable = False
+
+        return converted
+
+    def __column(self, name):
+        '''Gather a column of the selected states'''
+        column_idx = AircraftTrace.VARIABLE_MAP[name]
+
+        return (self.policy.column(self.__data, name, self.__indices)
+                + self.__offset[column_idx])
+
+    def t(self, idx):
+        '''Get the time of a specific state'''
+        return numpy.array(self.__data['t'][self.__indices[idx]],
+                           dtype=numpy.float64)
+
+    def state(self, idx):
+        '''Get the aircraft state at an index'''
+        return AircraftState(self.__offset_state(
+            self.policy.row(self.__data, self.__indices[idx])))
 
     def n_points(self):
         '''The size of the data'''
-        return len(self.__data[:,0])
+        return len(self.__indices)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python2
+'''A file based catalog of the traces and results of many runs
+
+The catalog is a directory with an index.json file, the traces of each run
+in a columnar .npz file (see columnar_writer) and the LOS and conflict
+events and the per aircraft results of all runs in chunks of columnar .npz
+files. The index keeps the runs, callsigns, time range and smallest cpa of
+each chunk, so a query only loads the chunks that can have matching rows.
+'''
+
+import collections
+import json
+import numpy
+import os
+
+from columnar_writer import write_columnar, read_columnar
+from histograms import duration_values
+from tools import nm2m
+
+# The number of rows that are collected before a chunk is written
+DEFAULT_CHUNK_ROWS = 10000
+
+# The number of loaded chunks that are kept for the next queries
+DEFAULT_CACHE_CHUNKS = 16
+
+# The kinds of events
+KINDS = ['los', 'conflict']
+
+EVENT_COLUMNS    = ['run', 'kind', 'acft1', 'acft2', 't_start', 't_end',
+                    'duration', 'cpa']
+
+AIRCRAFT_COLUMNS = ['run', 'callsign', 't_start', 't_end', 'path_deviation',
+                    'spd_change', 'hdg_change', 'state_change']
+
+def _empty_columns(names):
+    '''A dictionary with an empty list per column'''
+    return dict((name, []) for name in names)
+
+def _chunk_info(filename, columns, callsign_columns):
+    '''The index entry of a chunk'''
+    callsigns = set()
+    for name in callsign_columns:
+        callsigns.update(columns[name].tolist())
+
+    info = {'file'      : filename,
+            'n_rows'    : len(columns['run']),
+            'runs'      : sorted(set(columns['run'].tolist())),
+            'callsigns' : sorted(callsigns),
+            't_min'     : float(columns['t_start'].min()),
+            't_max'     : float(columns['t_end'].max())}
+
+    # The cpa is not defined for pairs without relative velocity
+    if 'cpa' in columns:
+        cpa = columns['cpa'][~numpy.isnan(columns['cpa'])]
+        info['cpa_min'] = float(cpa.min()) if len(cpa) else None
+
+    return info
+
+def _chunk_matches(info, runs, callsign, t_begin, t_end):
+    '''Check with the index if a chunk can have rows of a query'''
+    if runs is not None and not set(runs) & set(info['runs']):
+        return False
+
+    if callsign is not None and callsign not in info['callsigns']:
+        return False
+
+    if t_begin is not None and info['t_max'] < t_begin:
+        return False
+
+    if t_end is not None and info['t_min'] > t_end:
+        return False
+
+    return True
+
+class Catalog:
+    '''The catalog in a directory, it is created if it does not exist
+
+    Runs that are added are kept in memory until chunk_rows rows have been
+    collected or flush is called. The index is written together with the
+    chunks, so every chunk on disk is in the index. The traces of runs added
+    after the last chunk are only in the index after the next chunk or
+    flush. Queries keep the cache_chunks chunks that were used last.
+    '''
+
+    def __init__(self, directory, chunk_rows=DEFAULT_CHUNK_ROWS,
+                 cache_chunks=DEFAULT_CACHE_CHUNKS):
+        self.directory    = directory
+        self.chunk_rows   = chunk_rows
+        self.cache_chunks = cache_chunks
+
+        for subdirectory in ['traces', 'event_chunks', 'aircraft_chunks']:
+            path = os.path.join(directory, subdirectory)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        index_filename = os.path.join(directory, 'index.json')
+        if os.path.exists(index_filename):
+            with open(index_filename) as index_file:
+                self.index = json.load(index_file)
+        else:
+            self.index = {'runs'            : [],
+                          'event_chunks'    : [],
+                          'aircraft_chunks' : []}
+
+        self.__run_idx  = dict((run['run_id'], idx)
+                               for (idx, run) in enumerate(self.index['runs']))
+        self.__events   = _empty_columns(EVENT_COLUMNS)
+        self.__aircraft = _empty_columns(AIRCRAFT_COLUMNS)
+        self.__chunks   = collections.OrderedDict()
+
+    def __path(self, *parts):
+        '''A path inside the catalog'''
+        return os.path.join(self.directory, *parts)
+
+    def add_run(self, run_id, aircraft, los_data=(), conflict_data=(),
+                per_aircraft=None, store_traces=True):
+        '''Add a run with its LOS and conflict data (see check_actual_los and
+        check_conflicts) and optionally the (path_deviation, cmd_change,
+        state_change) of per_aircraft_calculations'''
+        if run_id in self.__run_idx:
+            raise ValueError('Run {} is already in the catalog'.format(run_id))
+
+        run = len(self.index['runs'])
+
+        traces = None
+        if store_traces:
+            traces = os.path.join('traces', '{:06d}.npz'.format(run))
+            write_columnar(aircraft, self.__path(traces))
+
+        t_start = [acft.t(0) for acft in aircraft]
+        t_end   = [acft.t(-1) for acft in aircraft]
+
+        self.index['runs'].append({
+            'run_id'      : run_id,
+            'traces'      : traces,
+            'callsigns'   : [acft.callsign for acft in aircraft],
+            't_start'     : float(min(t_start)) if aircraft else None,
+            't_end'       : float(max(t_end)) if aircraft else None,
+            'n_los'       : len(los_data),
+            'n_conflicts' : len(conflict_data)})
+        self.__run_idx[run_id] = run
+
+        for (kind, pair_data) in zip(KINDS, [los_data, conflict_data]):
+            events = self.__events
+            events['run'].extend([run] * len(pair_data))
+            events['kind'].extend([KINDS.index(kind)] * len(pair_data))
+            events['acft1'].extend([pair['acft1'] for pair in pair_data])
+            events['acft2'].extend([pair['acft2'] for pair in pair_data])
+            events['t_start'].extend([pair['time'][0] for pair in pair_data])
+            events['t_end'].extend([pair['time'][-1] for pair in pair_data])
+            events['duration'].extend(duration_values(pair_data))
+            events['cpa'].extend([pair['cpa'] for pair in pair_data])
+
+        if per_aircraft is not None:
+            (path_deviation, cmd_change, state_change) = per_aircraft
+
+            results = self.__aircraft
+            results['run'].extend([run] * len(aircraft))
+            results['callsign'].extend([acft.callsign for acft in aircraft])
+            results['t_start'].extend(t_start)
+            results['t_end'].extend(t_end)
+            results['path_deviation'].extend([deviation.max()
+                                              for deviation in path_deviation])
+            results['spd_change'].extend([spd for (spd, hdg) in cmd_change])
+            results['hdg_change'].extend([hdg for (spd, hdg) in cmd_change])
+            results['state_change'].extend(state_change)
+
+        if (len(self.__events['run']) >= self.chunk_rows or
+            len(self.__aircraft['run']) >= self.chunk_rows):
+            self.__write_chunks()
+
+    def __write_chunk(self, kind, rows, names, callsign_columns):
+        '''Write the collected rows of one table into a new chunk'''
+        if not rows['run']:
+            return
+
+        chunks   = self.index[kind + '_chunks']
+        filename = os.path.join(kind + '_chunks',
+                                '{:06d}.npz'.format(len(chunks)))
+
+        columns = dict((name, numpy.array(rows[name])) for name in names)
+
+        with open(self.__path(filename), 'wb') as npz_file:
+            numpy.savez_compressed(npz_file, **columns)
+
+        chunks.append(_chunk_info(filename, columns, callsign_columns))
+
+        for name in names:
+            rows[name] = []
+
+    def __write_chunks(self):
+        '''Write the collected events and aircraft results and the index'''
+        self.__write_chunk('event', self.__events, EVENT_COLUMNS,
+                           ['acft1', 'acft2'])
+        self.__write_chunk('aircraft', self.__aircraft, AIRCRAFT_COLUMNS,
+                           ['callsign'])
+
+        # Replace the index in one step, it is never partly written
+        index_filename = self.__path('index.json')
+        with open(index_filename + '.tmp', 'w') as index_file:
+            json.dump(self.index, index_file)
+
+        os.rename(index_filename + '.tmp', index_filename)
+
+    def flush(self):
+        '''Write all collected rows and the index'''
+        self.__write_chunks()
+
+    def run_ids(self):
+        '''The ids of all runs in the catalog'''
+        return [run['run_id'] for run in self.index['runs']]
+
+    def __load(self, info):
+        '''Load the columns of a chunk, the chunks that were used last are
+        kept'''
+        columns = self.__chunks.pop(info['file'], None)
+
+        if columns is None:
+            with numpy.load(self.__path(info['file'])) as chunk:
+                columns = dict((name, chunk[name]) for name in chunk.files)
+
+        self.__chunks[info['file']] = columns
+
+        while len(self.__chunks) > self.cache_chunks:
+            self.__chunks.popitem(last=False)
+
+        return columns
+
+    def __query(self, kind, run_ids, callsign_columns, callsign,
+                t_begin, t_end, select_chunk, select):
+        '''Collect the rows of the chunks of a table that match a query,
+        select_chunk checks the index entry of a chunk and select gives the
+        rows of a chunk that match the other conditions'''
+        runs = None
+        if run_ids is not None:
+            runs = [self.__run_idx[run_id] for run_id in run_ids
+                    if run_id in self.__run_idx]
+
+        names   = EVENT_COLUMNS if kind == 'event' else AIRCRAFT_COLUMNS
+        results = _empty_columns(names)
+
+        for info in self.index[kind + '_chunks']:
+            if not (_chunk_matches(info, runs, callsign, t_begin, t_end)
+                    and select_chunk(info)):
+                continue
+
+            columns = self.__load(info)
+            selected = select(info, columns)
+
+            if runs is not None:
+                selected &= numpy.in1d(columns['run'], runs)
+            if callsign is not None:
+                selected &= numpy.any([columns[name] == callsign
+                                       for name in callsign_columns], axis=0)
+            if t_begin is not None:
+                selected &= columns['t_end'] >= t_begin
+            if t_end is not None:
+                selected &= columns['t_start'] <= t_end
+
+            for name in names:
+                results[name].append(columns[name][selected])
+
+        results = dict((name, numpy.concatenate(arrays) if arrays
+                        else numpy.array([]))
+                       for (name, arrays) in results.items())
+
+        # Replace the run numbers by the run ids
+        all_ids = numpy.array(self.run_ids() or [''])
+        results['run'] = all_ids[results['run'].astype(int)]
+
+        return results
+
+    def query_events(self, kind=None, max_cpa=None, run_ids=None,
+                     callsign=None, t_begin=None, t_end=None):
+        '''The events ('los', 'conflict' or both) with a cpa below max_cpa
+        [m], of the given runs and callsign, that overlap the time window
+        between t_begin and t_end. Returns a dictionary of EVENT_COLUMNS
+        arrays, kind is 0 for a LOS and 1 for a conflict.'''
+        def select_chunk(info):
+            # The index has the smallest cpa of each chunk
+            return (max_cpa is None or
+                    (info['cpa_min'] is not None and info['cpa_min'] < max_cpa))
+
+        def select(info, columns):
+            selected = numpy.ones(info['n_rows'], dtype=bool)
+
+            if kind is not None:
+                selected &= columns['kind'] == KINDS.index(kind)
+            if max_cpa is not None:
+                with numpy.errstate(invalid='ignore'):
+                    selected &= columns['cpa'] < max_cpa
+
+            return selected
+
+        return self.__query('event', run_ids, ['acft1', 'acft2'],
+                            callsign, t_begin, t_end, select_chunk, select)
+
+    def query_aircraft(self, run_ids=None, callsign=None, t_begin=None,
+                       t_end=None):
+        '''The per aircraft results of the given runs and callsign that fly
+        in the time window between t_begin and t_end. Returns a dictionary of
+        AIRCRAFT_COLUMNS arrays.'''
+        def select_chunk(info):
+            return True
+
+        def select(info, columns):
+            return numpy.ones(info['n_rows'], dtype=bool)
+
+        return self.__query('aircraft', run_ids, ['callsign'],
+                            callsign, t_begin, t_end, select_chunk, select)
+
+    def query_runs(self, callsign=None, t_begin=None, t_end=None):
+        '''The ids of the runs with an aircraft and flying in a time window'''
+        return [run['run_id'] for run in self.index['runs']
+                if (callsign is None or callsign in run['callsigns'])
+                and (t_begin is None or run['t_end'] >= t_begin)
+                and (t_end is None or run['t_start'] <= t_end)]
+
+    def traces(self, run_id, callsigns=None):
+        '''Read the aircraft traces of a run, optionally only some'''
+        traces = self.index['runs'][self.__run_idx[run_id]]['traces']
+
+        if traces is None:
+            raise ValueError('The traces of run {} are not stored'.format(
+                run_id))
+
+        aircraft = read_columnar(self.__path(traces))
+
+        return [acft for acft in aircraft
+                if callsigns is None or acft.callsign in callsigns]
+
+
+def main():
+    '''Entry point when running as a script, adds the given log files to a
+    catalog and lists the LOS under 2 NM of all runs'''
+    import BSpostprocessing
+    from logreader import parse_logfile
+
+    if len(sys.argv) < 2:
+        print 'Provide a catalog directory and the log files to add!'
+        return 1
+
+    catalog = Catalog(sys.argv[1])
+
+    for filename in sys.argv[2:]:
+        aircraft = parse_logfile(filename)
+        results  = BSpostprocessing.analyse_run(aircraft)
+
+        catalog.add_run(filename, aircraft, results['los'],
+                        results['conflicts'],
+                        (results['path_deviation'], results['cmd_change'],
+                         results['state_change']))
+
+    catalog.flush()
+
+    events = catalog.query_events('los', max_cpa=nm2m(2.0))
+
+    print
+    for idx in range(len(events['run'])):
+        print '{}: {} and {} from {} s \tto {} s'.format(
+            events['run'][idx], events['acft1'][idx], events['acft2'][idx],
+            events['t_start'][idx], events['t_end'][idx])
+
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
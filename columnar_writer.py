@@ -0,0 +1,78 @@
+'''Tools to write aircraft data into a compact columnar numpy file'''
+
+import numpy
+
+from acfttrace import AircraftTrace
+
+def _stack_column(aircraft, name):
+    '''Concatenate a column of all aircraft into a single array'''
+    return numpy.concatenate([acft.column(name) for acft in aircraft])
+
+def write_columnar(aircraft, filename, compressed=True):
+    '''Write the aircraft to a single .npz file
+
+    Every variable is stored as one array with the samples of all aircraft
+    after each other. The 'acft_idx' array gives the index in 'callsigns' of
+    each sample and 'offsets' the first sample of each aircraft.
+    '''
+    n_points = numpy.array([acft.n_points() for acft in aircraft])
+
+    columns = dict((name, _stack_column(aircraft, name))
+                   for name in AircraftTrace.VARIABLE_NAMES)
+
+    columns['callsigns'] = numpy.array([acft.callsign for acft in aircraft])
+    columns['acft_idx']  = numpy.repeat(numpy.arange(len(aircraft)), n_points)
+    columns['offsets']   = numpy.concatenate(([0], numpy.cumsum(n_points)))
+
+    print('Writing to: ' + filename)
+    with open(filename, 'wb') as npz_file:
+        if compressed:
+            numpy.savez_compressed(npz_file, **columns)
+        else:
+            numpy.savez(npz_file, **columns)
+
+def read_columnar(filename):
+    '''Read a file written by write_columnar back into aircraft traces'''
+    with numpy.load(filename) as columns:
+        offsets = columns['offsets']
+
+        # Files written before the altitude was stored have no alt column
+        data      = numpy.column_stack(
+            [columns[name] if name in columns.files
+             else numpy.repeat(numpy.nan, offsets[-1])
+             for name in AircraftTrace.VARIABLE_NAMES])
+        callsigns = columns['callsigns']
+
+    return [AircraftTrace.from_data(str(callsign), data[begin:end])
+            for (callsign, begin, end) in zip(callsigns,
+                                              offsets[:-1], offsets[1:])]
+
+
+def main():
+    '''Entry point when we run as a script'''
+
+    import logreader
+
+    # Check if we started with the correct arguemnts (either none or one)
+    n_args = len(sys.argv)
+
+    if n_args == 1:
+        filename = 'input.txt'
+    elif n_args == 2:
+        filename = sys.argv[1]
+    else:
+        print 'Too many arguments provided!'
+        return 1
+
+    print 'Parsing: ' + filename
+
+    # Grab the aircraft traces, and write the full run
+    aircraft = logreader.parse_logfile(filename)
+
+    write_columnar(aircraft, 'test.npz')
+
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python2
+'''Traffic complexity metrics per time step, in a single pass over the fleet
+
+Every time step gives a row of the series:
+
+    t               the simulation time [s]
+    n_aircraft      the number of aircraft with a sample at t
+    density         the mean number of other aircraft within density_radius
+    n_los           the number of pairs closer than pz_radius
+    n_conflicts     the number of pairs in LOS or predicted to come within
+                    pz_radius within the lookahead time
+    closing_speed   the mean closing speed of the approaching pairs within
+                    density_radius [m/s], NaN without any
+
+The steps are read one after the other, either from the traces or straight
+from a log file, and the pairs of a step are compared in blocks of aircraft,
+so only the series itself grows with the length of a run.
+'''
+
+import os
+
+import numpy
+
+import plot_functions
+
+from BSpostprocessing import (create_position_vector, create_velocity_vector,
+                              velocity_components)
+from acfttrace import VARIABLE_NAMES
+from logreader import iter_log_chunks
+from tools import nm2m
+
+# The radius of the neighbourhood of an aircraft [m]
+DEFAULT_DENSITY_RADIUS = nm2m(20.0)
+
+# How far ahead conflicts are predicted [s]
+DEFAULT_LOOKAHEAD = 300.0
+
+# The number of aircraft compared to all others at once
+BLOCK_SIZE = 64
+
+SERIES_NAMES = ['t', 'n_aircraft', 'density', 'n_los', 'n_conflicts',
+                'closing_speed']
+
+def _split_steps(t):
+    '''The (first, last) rows of each time step in sorted times'''
+    bounds = numpy.flatnonzero(numpy.diff(t)) + 1
+
+    return zip(numpy.concatenate(([0], bounds)),
+               numpy.concatenate((bounds, [len(t)])))
+
+def iter_fleet_steps(aircraft):
+    '''Yield (t, positions, velocities) for each time step of the traces,
+    with an (n, 2) array for the n aircraft that have a sample at t'''
+    if not aircraft:
+        return
+
+    t          = numpy.concatenate([acft.column('t') for acft in aircraft])
+    positions  = numpy.vstack([create_position_vector(acft)
+                               for acft in aircraft])
+    velocities = numpy.vstack([create_velocity_vector(acft)
+                               for acft in aircraft])
+
+    order = numpy.argsort(t, kind='mergesort')
+    (t, positions, velocities) = (t[order], positions[order],
+                                  velocities[order])
+
+    for (first, last) in _split_steps(t):
+        yield (t[first], positions[first:last], velocities[first:last])
+
+def _log_step(rows):
+    '''The (t, positions, velocities) of the rows of one time step'''
+    column = dict((name, idx) for (idx, name) in enumerate(VARIABLE_NAMES))
+
+    return (rows[0, column['t']],
+            rows[:, [column['posx'], column['posy']]],
+            velocity_components(rows[:, column['tas']],
+                                rows[:, column['psi']]))
+
+def iter_log_steps(fname, chunk_size=100000):
+    '''Yield (t, positions, velocities) for each time step of a log file,
+    without building the traces
+
+    The rows of a time step need to follow each other, as BlueSky writes
+    them. Only one chunk of rows is in memory at a time.
+    '''
+    rest = None
+
+    for (_, data) in iter_log_chunks(fname, chunk_size):
+        if rest is not None:
+            data = numpy.vstack((rest, data))
+
+        steps = _split_steps(data[:, VARIABLE_NAMES.index('t')])
+
+        # The last step can continue in the next chunk
+        for (first, last) in steps[:-1]:
+            yield _log_step(data[first:last])
+
+        rest = data[steps[-1][0]:]
+
+    if rest is not None:
+        yield _log_step(rest)
+
+def step_complexity(positions, velocities, pz_radius=nm2m(5.0),
+                    density_radius=DEFAULT_DENSITY_RADIUS,
+                    lookahead=DEFAULT_LOOKAHEAD, block_size=BLOCK_SIZE):
+    '''The (density, n_los, n_conflicts, closing_speed) of one time step'''
+    n_aircraft = len(positions)
+
+    n_neighbours = 0
+    n_los        = 0
+    n_conflicts  = 0
+    n_closing    = 0
+    closing_sum  = 0.0
+
+    for first in range(0, n_aircraft, block_size):
+        rows = numpy.arange(first, min(first + block_size, n_aircraft))
+
+        # Position and velocity of the others relative to each aircraft of
+        # the block, every pair is only counted in the row of its first
+        # aircraft
+        rel_pos = positions[numpy.newaxis] - positions[rows, numpy.newaxis]
+        rel_vel = velocities[numpy.newaxis] - velocities[rows, numpy.newaxis]
+        pairs   = numpy.arange(n_aircraft) > rows[:, numpy.newaxis]
+
+        distance = numpy.sqrt((rel_pos ** 2).sum(axis=-1))
+        pos_vel  = (rel_pos * rel_vel).sum(axis=-1)
+        vel_sq   = (rel_vel ** 2).sum(axis=-1)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            closing = -pos_vel / distance
+            t_cpa   = -pos_vel / vel_sq
+            d_cpa   = numpy.sqrt(numpy.maximum(
+                distance ** 2 + pos_vel * t_cpa, 0.0))
+
+            near        = pairs & (distance < density_radius)
+            approaching = near & (closing > 0)
+            los         = pairs & (distance < pz_radius)
+            conflict    = los | (pairs & (t_cpa > 0) & (t_cpa < lookahead) &
+                                 (d_cpa < pz_radius))
+
+        # A pair is a neighbour of both aircraft
+        n_neighbours += 2 * near.sum()
+        n_los        += los.sum()
+        n_conflicts  += conflict.sum()
+        n_closing    += approaching.sum()
+        closing_sum  += closing[approaching].sum()
+
+    density       = float(n_neighbours) / n_aircraft if n_aircraft else 0.0
+    closing_speed = closing_sum / n_closing if n_closing else numpy.nan
+
+    return (density, int(n_los), int(n_conflicts), closing_speed)
+
+def iter_complexity(steps, **kwargs):
+    '''Yield a row of the series (see SERIES_NAMES) for each of the
+    (t, positions, velocities) steps, kwargs go to step_complexity'''
+    for (t, positions, velocities) in steps:
+        yield ((t, len(positions)) +
+               step_complexity(positions, velocities, **kwargs))
+
+def complexity_series(steps, **kwargs):
+    '''Collect the series of the steps in a dictionary of arrays'''
+    rows = list(iter_complexity(steps, **kwargs))
+
+    columns = zip(*rows) if rows else [[]] * len(SERIES_NAMES)
+
+    return dict((name, numpy.array(column, dtype=numpy.float64))
+                for (name, column) in zip(SERIES_NAMES, columns))
+
+def write_complexity(series, filename):
+    '''Write the series as a csv file with the header of the BlueSky logs'''
+    with open(filename, 'w') as csv_file:
+        csv_file.write('# Traffic complexity per time step\n')
+        csv_file.write('# ' + ', '.join(SERIES_NAMES) + '\n')
+
+        for row in zip(*[series[name] for name in SERIES_NAMES]):
+            csv_file.write(', '.join(repr(float(value)) for value in row)
+                           + '\n')
+
+def complexity_filename(xml_filename):
+    '''The csv file of the series that goes with an xml export'''
+    return os.path.splitext(xml_filename)[0] + '_complexity.csv'
+
+
+def main():
+    '''Entry point for this application when it's run as a script'''
+
+    # Check if we started with the correct arguemnts (either none or one)
+    n_args = len(sys.argv)
+
+    if n_args == 1:
+        filename = 'input.txt'
+    elif n_args == 2:
+        filename = sys.argv[1]
+    else:
+        print('Too many arguments provided!')
+        return 1
+
+    series = complexity_series(iter_log_steps(filename))
+
+    if not os.path.isdir('output'):
+        os.makedirs('output')
+
+    output_filename = complexity_filename(
+        os.path.join('output', os.path.basename(filename)))
+    write_complexity(series, output_filename)
+    print 'Written {} time steps to {}'.format(len(series['t']),
+                                               output_filename)
+
+    plot_functions.plot_complexity(series)
+    plot_functions.show()
+
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(main())
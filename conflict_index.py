@@ -0,0 +1,231 @@
+'''Read the conflict and LOS logs of BlueSky into an index of events
+
+The CONFLOG and LOSLOG files have the same layout as the other BlueSky logs,
+a comment line, a line with the headings and a row per logged event with the
+simulation time and the callsigns of both aircraft. Rows of the same pair
+that follow each other within max_gap seconds are merged into one event, the
+index then holds a (pair, t_start, t_end) row per event.
+'''
+
+import csv
+import os
+import numpy
+import random
+
+from logreader import _strip_header
+from tools import m2nm
+
+# Rows of a pair further apart than this start a new event [s]
+DEFAULT_MAX_GAP = 30.0
+
+# The windows of the events are padded by this much for exact checks [s]
+DEFAULT_MARGIN = 30.0
+
+# The headings that can hold the callsigns of both aircraft
+CALLSIGN_HEADINGS = [('id1', 'id2'), ('acid1', 'acid2'), ('ac1', 'ac2')]
+
+def _pair_key(callsign1, callsign2):
+    '''The pair of callsigns in a fixed order'''
+    return tuple(sorted((callsign1, callsign2)))
+
+def _callsign_columns(headings):
+    '''The columns of both callsigns, the two after the time by default'''
+    headings = [heading.strip(' ,').lower() for heading in headings]
+
+    for (heading1, heading2) in CALLSIGN_HEADINGS:
+        if heading1 in headings and heading2 in headings:
+            return (headings.index(heading1), headings.index(heading2))
+
+    return (1, 2)
+
+def _merge_rows(times, max_gap):
+    '''Merge sorted row times into (t_start, t_end) windows'''
+    breaks = numpy.flatnonzero(numpy.diff(times) > max_gap)
+
+    starts = numpy.concatenate(([0], breaks + 1))
+    ends   = numpy.concatenate((breaks, [len(times) - 1]))
+
+    return zip(times[starts], times[ends])
+
+class ConflictIndex:
+    '''A table of (acft1, acft2, t_start, t_end) events, sorted by pair and
+    start time, with the windows of each pair looked up by callsigns
+
+    The windows of a pair do not overlap, the callsigns of a pair are stored
+    in sorted order.
+    '''
+
+    def __init__(self, events=()):
+        events = sorted((_pair_key(callsign1, callsign2), t_start, t_end)
+                        for (callsign1, callsign2, t_start, t_end) in events)
+
+        self.acft1   = [pair[0] for (pair, _, _) in events]
+        self.acft2   = [pair[1] for (pair, _, _) in events]
+        self.t_start = numpy.array([t_start for (_, t_start, _) in events],
+                                   dtype=numpy.float64)
+        self.t_end   = numpy.array([t_end for (_, _, t_end) in events],
+                                   dtype=numpy.float64)
+
+        # The rows of the events of each pair
+        self.__rows = {}
+        for (row, (pair, _, _)) in enumerate(events):
+            (first, _) = self.__rows.get(pair, (row, row))
+            self.__rows[pair] = (first, row + 1)
+
+    def __len__(self):
+        return len(self.t_start)
+
+    def __iter__(self):
+        '''Iterate over the (acft1, acft2, t_start, t_end) events'''
+        return iter(zip(self.acft1, self.acft2, self.t_start, self.t_end))
+
+    def pairs(self):
+        '''The sorted (acft1, acft2) callsigns of all pairs with events'''
+        return sorted(self.__rows)
+
+    def has_pair(self, callsign1, callsign2):
+        '''Check if a pair has any events'''
+        return _pair_key(callsign1, callsign2) in self.__rows
+
+    def windows(self, callsign1, callsign2):
+        '''The (t_start, t_end) windows of a pair, an (n, 2) array'''
+        (first, last) = self.__rows.get(_pair_key(callsign1, callsign2),
+                                        (0, 0))
+
+        return numpy.column_stack((self.t_start[first:last],
+                                   self.t_end[first:last]))
+
+    def mask(self, callsign1, callsign2, t, margin=DEFAULT_MARGIN):
+        '''Which of the times t are inside a window of a pair, padded by
+        margin on both sides'''
+        windows = self.windows(callsign1, callsign2)
+
+        t = numpy.asarray(t)
+
+        if not len(windows):
+            return numpy.zeros(t.shape, dtype=bool)
+
+        # The last window that starts before each time
+        idx = numpy.searchsorted(windows[:, 0] - margin, t, 'right') - 1
+
+        return (idx >= 0) & (t <= windows[numpy.maximum(idx, 0), 1] + margin)
+
+    def events_between(self, t_begin, t_end):
+        '''The events that overlap the window between t_begin and t_end'''
+        overlap = (self.t_start <= t_end) & (self.t_end >= t_begin)
+
+        return [event for (event, selected) in zip(self, overlap) if selected]
+
+    def union(self, other):
+        '''An index with the events of both indices, windows of a pair that
+        overlap are merged'''
+        events = []
+
+        for pair in sorted(set(self.pairs()) | set(other.pairs())):
+            windows = numpy.vstack((self.windows(*pair),
+                                    other.windows(*pair)))
+            windows = windows[numpy.argsort(windows[:, 0])]
+
+            (t_start, t_end) = windows[0]
+            for (next_start, next_end) in windows[1:]:
+                if next_start <= t_end:
+                    t_end = max(t_end, next_end)
+                else:
+                    events.append(pair + (t_start, t_end))
+                    (t_start, t_end) = (next_start, next_end)
+
+            events.append(pair + (t_start, t_end))
+
+        return ConflictIndex(events)
+
+
+def read_conflict_log(fname, max_gap=DEFAULT_MAX_GAP):
+    '''Read a CONFLOG or LOSLOG file into a ConflictIndex'''
+    filename = os.path.join('logs', fname)
+
+    with open(filename, 'r') as logfile:
+        headings = _strip_header(logfile)
+        (column1, column2) = _callsign_columns(headings)
+
+        hlen = len(headings)
+        times = {}
+        for row in csv.reader(logfile):
+            if not hlen == len(row):
+                break
+
+            pair = _pair_key(row[column1].strip(), row[column2].strip())
+            times.setdefault(pair, []).append(float(row[0]))
+
+    events = [pair + window
+              for (pair, pair_times) in times.items()
+              for window in _merge_rows(numpy.sort(pair_times), max_gap)]
+
+    return ConflictIndex(events)
+
+
+def verify_events(event_index, statistics, pz_radius, quantity='distance',
+                  n_samples=None, margin=DEFAULT_MARGIN, seed=None):
+    '''Spot-check the events of the simulator against our own geometry
+
+    For a random sample of n_samples events (default all) the minimum of
+    quantity ('distance' for LOS, 'cpa' for conflicts) of the pair (see
+    collect_stats) is taken within the padded window of the event. An event
+    is confirmed if that minimum is below pz_radius. Returns a dictionary per
+    checked event, events of pairs without statistics are not confirmed.
+    '''
+    pair_stats = dict((_pair_key(pair['acft1'].callsign,
+                                 pair['acft2'].callsign), pair)
+                      for pair in statistics)
+
+    events = list(event_index)
+    if n_samples is not None and n_samples < len(events):
+        events = random.Random(seed).sample(events, n_samples)
+
+    results = []
+
+    for (callsign1, callsign2, t_start, t_end) in events:
+        minimum = numpy.nan
+
+        pair = pair_stats.get((callsign1, callsign2))
+        if pair is not None:
+            t = pair['acft1'].column('t')
+            in_window = ((t >= t_start - margin) & (t <= t_end + margin))
+
+            if in_window.any():
+                minimum = pair[quantity][in_window].min()
+
+        results.append({'acft1'     : callsign1,
+                        'acft2'     : callsign2,
+                        't_start'   : t_start,
+                        't_end'     : t_end,
+                        'minimum'   : minimum,
+                        'confirmed' : bool(minimum < pz_radius)})
+
+    print
+    print 'Verified {} events, {} not confirmed'.format(
+        len(results), sum(not result['confirmed'] for result in results))
+    for result in results:
+        if not result['confirmed']:
+            print '{} and {} from {} s \tto {} s\t, minimum {}: {}'.format(
+                result['acft1'], result['acft2'],
+                result['t_start'], result['t_end'],
+                quantity, m2nm(result['minimum']))
+
+    return results
+
+
+def main():
+    '''Entry point when running as a script'''
+
+    if len(sys.argv) != 2:
+        print 'Provide a CONFLOG or LOSLOG file!'
+        return 1
+
+    for event in read_conflict_log(sys.argv[1]):
+        print '{} and {} from {} s \tto {} s'.format(*event)
+
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
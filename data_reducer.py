@@ -1,48 +1,157 @@
 '''Reduce a data set based on some reduction parameters'''
 
-import copy
+import collections
+import multiprocessing
 import numpy
 import time
+import traceback
 
-from tools          import BoundingBox
-from xmltree_writer import write_xml
+from tools           import BoundingBox, ExtentIndex, nm2m, kts2ms, deg2rad
+from xmltree_writer  import write_xml_streaming
+from columnar_writer import write_columnar
+
+# Default error bounds for the adaptive reduction
+DEFAULT_MAX_POS_ERROR = nm2m(0.1)
+DEFAULT_MAX_HDG_ERROR = deg2rad(1.0)
+DEFAULT_MAX_SPD_ERROR = kts2ms(2.0)
 
 def find_reduced_indices(remaining_acft, reduction_parameters):
-    '''Calculate the reduced indices based on data from the gui'''
+    '''Calculate the reduced indices based on data from the gui
+
+    The stride method leaves out the point at t_end, as it always has, the
+    adaptive method keeps it so the reduced trajectory ends where the
+    window ends.
+    '''
     # Collect the required parameters
     t       = remaining_acft[0].column('t')
     
     t_begin = reduction_parameters['t_begin']
     t_end   = reduction_parameters['t_end']
-    stride  = reduction_parameters['stride']
+    method  = reduction_parameters.get('method', 'stride')
 
     # Find the corresponding indices
     begin_idx = numpy.where(t <= t_begin)[0][-1]
     end_idx   = numpy.where(t <= t_end)  [0][-1]
 
+    if method == 'adaptive':
+        return find_adaptive_indices(remaining_acft, begin_idx, end_idx,
+                                     reduction_parameters)
+
+    stride  = reduction_parameters['stride']
+
     # Create a range with the required stride
     reduced_indices = numpy.arange(begin_idx, end_idx, stride)
 
     return reduced_indices
 
-def center_data(aircraft):
-    '''Calculate the center of all aircraft and shift them'''
+def write_output(aircraft, filename, output_format='xml', extent=None):
+    '''Write the aircraft in one of the output formats: 'xml' for MVIEW,
+    'xml.gz' for gzip compressed MVIEW or 'npz' for the columnar format'''
+    if output_format == 'xml':
+        write_xml_streaming(aircraft, filename, extent=extent)
+    elif output_format == 'xml.gz':
+        write_xml_streaming(aircraft, filename, compress=True, extent=extent)
+    elif output_format == 'npz':
+        write_columnar(aircraft, filename)
+    else:
+        raise ValueError('Unknown output format: ' + output_format)
+
+def _interpolation_error(data, first, last, frac):
+    '''Error of linear interpolation between two rows for the rows between'''
+    return data[first] + frac * (data[last] - data[first]) - data[first+1:last]
+
+def find_adaptive_indices(remaining_acft, begin_idx, end_idx,
+                          reduction_parameters):
+    '''Select the indices to keep with a Douglas-Peucker style reduction
+
+    A point is dropped when linear interpolation in time between the kept
+    neighbours reproduces the position, heading and speed of every aircraft
+    within the error bounds. The indices are chosen jointly for all aircraft
+    so the logpoints stay synchronous. Both begin_idx and end_idx are kept.
+    '''
+    max_pos_error = reduction_parameters.get('max_pos_error',
+                                             DEFAULT_MAX_POS_ERROR)
+    max_hdg_error = reduction_parameters.get('max_hdg_error',
+                                             DEFAULT_MAX_HDG_ERROR)
+    max_spd_error = reduction_parameters.get('max_spd_error',
+                                             DEFAULT_MAX_SPD_ERROR)
+    max_stride    = reduction_parameters.get('max_stride')
+
+    window = slice(begin_idx, end_idx + 1)
+
+    t = remaining_acft[0].column('t')[window]
+
+    # Arrays of (time, aircraft), headings are unwrapped so the
+    # interpolation does not jump at +-180 degrees
+    posx = numpy.column_stack([acft.column('posx')[window]
+                               for acft in remaining_acft])
+    posy = numpy.column_stack([acft.column('posy')[window]
+                               for acft in remaining_acft])
+    psi  = numpy.column_stack([numpy.unwrap(acft.column('psi')[window])
+                               for acft in remaining_acft])
+    tas  = numpy.column_stack([acft.column('tas')[window]
+                               for acft in remaining_acft])
+
+    keep = numpy.zeros(len(t), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    segments = [(0, len(t) - 1)]
+
+    while segments:
+        (first, last) = segments.pop()
+
+        # Repeated log rows have the same time, only their ends are kept
+        if last - first < 2 or t[last] == t[first]:
+            continue
+
+        # Interpolate all interior points of the segment at once
+        frac = ((t[first+1:last] - t[first]) /
+                (t[last] - t[first]))[:, numpy.newaxis]
 
-    bb = BoundingBox(aircraft)
+        pos_error = numpy.hypot(_interpolation_error(posx, first, last, frac),
+                                _interpolation_error(posy, first, last, frac))
+        hdg_error = numpy.absolute(_interpolation_error(psi, first, last, frac))
+        spd_error = numpy.absolute(_interpolation_error(tas, first, last, frac))
 
-    (xmin,xmax,ymin,ymax) = bb.extent()
+        # The error relative to the bounds, worst aircraft at each point
+        error = numpy.maximum(numpy.maximum(pos_error / max_pos_error,
+                                            hdg_error / max_hdg_error),
+                              spd_error / max_spd_error).max(axis=1)
+
+        split_idx = first + 1 + error.argmax()
+
+        if error.max() <= 1.0:
+            # Close enough, only split further to honour the maximum stride
+            if max_stride is None or last - first <= max_stride:
+                continue
+
+            split_idx = first + (last - first) // 2
+
+        keep[split_idx] = True
+
+        segments.append((first, split_idx))
+        segments.append((split_idx, last))
+
+    return numpy.flatnonzero(keep) + begin_idx
+
+def center_data(aircraft, extent=None):
+    '''Calculate the center of all aircraft and shift them, returns the
+    extent after the shift. The extent is calculated if it is not given'''
+
+    if extent is None:
+        extent = BoundingBox(aircraft).extent()
+
+    (xmin,xmax,ymin,ymax) = extent
 
     xcenter = xmin + (xmax-xmin)/2.0
     ycenter = ymin + (ymax-ymin)/2.0
 
+    # The aircraft are views, the shift is applied when the data are read
     for acft in aircraft:
-        xpos = acft.column('posx')
-        xpos -= xcenter
+        acft.set_offset(posx=-xcenter, posy=-ycenter)
+
+    return (xmin-xcenter, xmax-xcenter, ymin-ycenter, ymax-ycenter)
 
-        ypos = acft.column('posy')
-        ypos -= ycenter
-    
-        
 
 class DataReducer:
     '''Helper class to reduce a set of data and write them'''
@@ -50,18 +159,27 @@ class DataReducer:
     def __init__(self, aircraft):
         self.aircraft = aircraft
 
-    def write_data(self, reduction_parameters, filename):
-        '''Reduce the data set and write the xml file'''
+        # Index the extent of the fleet once, the extent of each selection
+        # then comes from the index. Aircraft with a different number of
+        # points can not be indexed.
+        try:
+            self.extent_index = ExtentIndex(aircraft)
+        except ValueError:
+            self.extent_index = None
+
+    def reduce_data(self, reduction_parameters):
+        '''Select, reduce and center the aircraft, returns a list of views
+        and their extent'''
 
-        # Select the aircraft objects whos callsign show up in the callsign list
-        remaining_acft = copy.deepcopy([ acft for acft in self.aircraft
-                                         if acft.callsign
-                                         in reduction_parameters['callsigns'] ])
+        # Select the aircraft objects whos callsign show up in the callsign
+        # list, a view does not copy the data of the original trace
+        remaining_acft = [ acft.view() for acft in self.aircraft
+                           if acft.callsign
+                           in reduction_parameters['callsigns'] ]
 
         # Guess what this does 
         if not remaining_acft:
-            print 'No aircraft selected, skipping!'
-            return
+            return (remaining_acft, None)
 
         # Data are usally logged at a higher rate than required, we can skip
         # over a number of points each time by specifying a stride and a
@@ -73,14 +191,136 @@ class DataReducer:
         for acft in remaining_acft:
             acft.reduce(reduced_indices)
 
+        # The extent of the selected aircraft over the reduced time window
+        extent = None
+        if self.extent_index is not None:
+            t = remaining_acft[0].column('t')
+            extent = self.extent_index.extent(t[0], t[-1],
+                                              [acft.callsign
+                                               for acft in remaining_acft])
+
         # Center around the origin
-        center_data(remaining_acft)
+        extent = center_data(remaining_acft, extent)
+
+        return (remaining_acft, extent)
+
+    def write_data(self, reduction_parameters, filename, output_format='xml'):
+        '''Reduce the data set and write the output file'''
+
+        (remaining_acft, extent) = self.reduce_data(reduction_parameters)
+
+        if not remaining_acft:
+            print 'No aircraft selected, skipping!'
+            return
 
         # Time to write the data
-        print 'Writing xml file: ' + filename
+        print 'Writing {} file: {}'.format(output_format, filename)
         
         t_begin = time.time()
-        write_xml(remaining_acft, filename)
+        write_output(remaining_acft, filename, output_format, extent)
         t_end = time.time()
         
         print 'Writing took: {t} seconds'.format(t=t_end-t_begin)
+
+    def reduced_task(self, reduction_parameters, filename,
+                     output_format='xml'):
+        '''Reduce one job into a task for _write_reduced, with copies of
+        only the reduced data, None if no aircraft are selected'''
+        (remaining_acft, extent) = self.reduce_data(reduction_parameters)
+
+        if not remaining_acft:
+            print 'No aircraft selected for {}, skipping!'.format(filename)
+            return None
+
+        return (filename, output_format, extent,
+                [acft.materialize() for acft in remaining_acft])
+
+    def reduced_tasks(self, jobs, output_format='xml'):
+        '''Reduce a list of (reduction_parameters, filename) jobs into
+        tasks for _write_reduced, one job at a time'''
+        for (reduction_parameters, filename) in jobs:
+            task = self.reduced_task(reduction_parameters, filename,
+                                     output_format)
+
+            if task is not None:
+                yield task
+
+    def write_data_parallel(self, jobs, n_workers=None, output_format='xml',
+                            queue_depth=2):
+        '''Write a list of (reduction_parameters, filename) jobs using a
+        pool of worker processes, returns a list of (filename, error) tuples
+        for the jobs that failed
+
+        The jobs are reduced in this process, the workers only receive the
+        reduced arrays of their own job and not the whole fleet. A job is
+        only reduced when fewer than queue_depth tasks per worker are
+        waiting, so only those tasks are held in memory at once.
+        '''
+        n_workers   = n_workers or multiprocessing.cpu_count()
+        max_pending = queue_depth * n_workers
+
+        failures = []
+        pending  = collections.deque()
+        n_done   = [0]
+
+        def collect(filename, error):
+            '''Keep the failure of a job, if any, and report progress'''
+            if error:
+                failures.append((filename, error))
+
+            n_done[0] += 1
+            print 'Exported {n}/{total}: {f}{status}'.format(
+                n=n_done[0], total=len(jobs), f=filename,
+                status=' FAILED' if error else '')
+
+        t_begin = time.time()
+        pool = multiprocessing.Pool(n_workers)
+
+        try:
+            for (reduction_parameters, filename) in jobs:
+                try:
+                    task = self.reduced_task(reduction_parameters, filename,
+                                             output_format)
+                except Exception:
+                    collect(filename, traceback.format_exc())
+                    continue
+
+                if task is None:
+                    continue
+
+                # Wait for the oldest task when too many are outstanding
+                if len(pending) >= max_pending:
+                    collect(*pending.popleft().get())
+
+                pending.append(pool.apply_async(_write_reduced, (task,)))
+
+            while pending:
+                collect(*pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+
+        t_end = time.time()
+
+        print 'Writing took: {t} seconds'.format(t=t_end-t_begin)
+
+        if failures:
+            print
+            print '{} of {} exports failed:'.format(len(failures), len(jobs))
+            for (filename, error) in failures:
+                print filename
+                print error
+
+        return failures
+
+
+def _write_reduced(task):
+    '''Write one reduced set of aircraft, runs in a worker process'''
+    (filename, output_format, extent, aircraft) = task
+
+    try:
+        write_output(aircraft, filename, output_format, extent)
+    except Exception:
+        return (filename, traceback.format_exc())
+
+    return (filename, None)
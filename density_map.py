@@ -0,0 +1,144 @@
+'''Accumulate the positions of all aircraft into a 2-D density map'''
+
+import numpy
+
+from acfttrace import AircraftTrace
+from logreader import iter_log_chunks
+from tools import BoundingBox
+
+def _sample_durations(t):
+    '''The time since the previous sample, zero for the first sample'''
+    return numpy.ediff1d(t, to_begin=0.0)
+
+def _log_durations(callsigns, t, last_t):
+    '''The time since the previous sample of the same aircraft for a chunk
+    of log rows, last_t has the time of the last sample of each aircraft in
+    the earlier chunks and is updated with this chunk'''
+    callsigns = numpy.array(callsigns)
+
+    # Sort the rows by callsign, the rows of an aircraft keep their order
+    order     = numpy.argsort(callsigns, kind='mergesort')
+    callsigns = callsigns[order]
+    t         = t[order]
+
+    durations = _sample_durations(t)
+
+    # The first row of each aircraft continues from its earlier chunks
+    starts = numpy.flatnonzero(numpy.concatenate(
+        ([True], callsigns[1:] != callsigns[:-1])))
+    ends   = numpy.concatenate((starts[1:], [len(t)])) - 1
+
+    durations[starts] = [t_first - last_t.get(callsign, t_first)
+                         for (callsign, t_first)
+                         in zip(callsigns[starts].tolist(), t[starts])]
+
+    last_t.update(zip(callsigns[ends].tolist(), t[ends]))
+
+    # Back in the order of the rows
+    weights = numpy.empty_like(durations)
+    weights[order] = durations
+
+    return weights
+
+class DensityMap:
+    '''Counts of positions on a regular grid
+
+    The grid covers an extent (xmin, xmax, ymin, ymax) in meters, positions
+    outside it are ignored. With time weighting each sample counts for the
+    time since the previous sample of the aircraft, so the map shows the
+    occupancy in seconds.
+    '''
+
+    def __init__(self, extent, nbins=(200, 200)):
+        (xmin, xmax, ymin, ymax) = extent
+
+        self.extent = (xmin, xmax, ymin, ymax)
+        self.nbins  = tuple(nbins)
+        self.counts = numpy.zeros(self.nbins)
+
+        # Locations of losses of separation, (posx, posy) in meters
+        self.los_positions = numpy.empty((0, 2))
+
+    @classmethod
+    def from_aircraft(cls, aircraft, nbins=(200, 200), padding=0.0):
+        '''Create a map that covers the bounding box of the aircraft'''
+        boundingbox = BoundingBox(aircraft)
+        boundingbox.pad(padding)
+
+        return cls(boundingbox.extent(), nbins)
+
+    def add_positions(self, posx, posy, weights=None):
+        '''Add a chunk of positions, optionally weighted'''
+        (xmin, xmax, ymin, ymax) = self.extent
+
+        (counts, _, _) = numpy.histogram2d(posx, posy,
+                                           bins=self.nbins,
+                                           range=[[xmin, xmax], [ymin, ymax]],
+                                           weights=weights)
+        self.counts += counts
+
+    def add_aircraft(self, aircraft, time_weighted=False):
+        '''Add all positions of a list of aircraft in one go'''
+        posx = numpy.concatenate([acft.column('posx') for acft in aircraft])
+        posy = numpy.concatenate([acft.column('posy') for acft in aircraft])
+
+        weights = None
+        if time_weighted:
+            weights = numpy.concatenate([_sample_durations(acft.column('t'))
+                                         for acft in aircraft])
+
+        self.add_positions(posx, posy, weights)
+
+    def add_log(self, fname, time_weighted=False, chunk_size=100000):
+        '''Add the positions of a log file, reading it in chunks'''
+        t_idx    = AircraftTrace.VARIABLE_MAP['t']
+        posx_idx = AircraftTrace.VARIABLE_MAP['posx']
+        posy_idx = AircraftTrace.VARIABLE_MAP['posy']
+
+        # The time of the previous sample of each aircraft, this carries
+        # over to the next chunk
+        last_t = {}
+
+        for (callsigns, data) in iter_log_chunks(fname, chunk_size):
+            weights = None
+
+            if time_weighted:
+                weights = _log_durations(callsigns, data[:, t_idx], last_t)
+
+            self.add_positions(data[:, posx_idx], data[:, posy_idx], weights)
+
+    def add_los(self, los_data, aircraft):
+        '''Add the location of the closest point of each LOS (as returned by
+        check_actual_los), halfway between both aircraft'''
+        traces = dict((acft.callsign, acft) for acft in aircraft)
+
+        positions = []
+
+        for los in los_data:
+            acft1 = traces[los['acft1']]
+            acft2 = traces[los['acft2']]
+
+            in_los = numpy.in1d(acft1.column('t'), los['time'])
+
+            pos1 = numpy.column_stack((acft1.column('posx'),
+                                       acft1.column('posy')))[in_los]
+            pos2 = numpy.column_stack((acft2.column('posx'),
+                                       acft2.column('posy')))[in_los]
+
+            closest = numpy.hypot(*(pos2 - pos1).T).argmin()
+
+            positions.append((pos1[closest] + pos2[closest]) / 2.0)
+
+        if positions:
+            self.los_positions = numpy.vstack([self.los_positions] + positions)
+
+    def merge(self, other):
+        '''Add the counts of a map with the same grid'''
+        if (self.extent, self.nbins) != (other.extent, other.nbins):
+            raise ValueError('Cannot merge density maps with different grids')
+
+        self.counts += other.counts
+        self.los_positions = numpy.vstack((self.los_positions,
+                                           other.los_positions))
+
+        return self
@@ -0,0 +1,227 @@
+'''Fixed bin histograms that can be accumulated over many runs'''
+
+import json
+import numpy
+
+from tools import m2nm, ms2kts, rad2deg
+
+# The bins and labels of each histogram, these are the ones of the plots
+HISTOGRAMS = {
+    'path_deviation' : {'title'  : 'Path deviation',
+                        'xlabel' : 'Path deviation [NM]',
+                        'nbins'  : 20,
+                        'range'  : (0.0, 20.0)},
+    'speed_change'   : {'title'  : 'Largest speed change commands',
+                        'xlabel' : 'Speed change command [kts]',
+                        'nbins'  : 10,
+                        'range'  : (0.0, 100.0)},
+    'heading_change' : {'title'  : 'Largest heading change commands',
+                        'xlabel' : 'Heading change command [deg]',
+                        'nbins'  : 18,
+                        'range'  : (0.0, 180.0)},
+    'state_change'   : {'title'  : 'Largest state change commands',
+                        'xlabel' : 'State change command [kts]',
+                        'nbins'  : 15,
+                        'range'  : (0.0, 300.0)},
+    'los_cpa'        : {'title'  : 'Number of LOS',
+                        'xlabel' : 'CPA Distance [NM]',
+                        'nbins'  : 5,
+                        'range'  : (0.0, 5.0)},
+    'los_time'       : {'title'  : 'Time in LOS',
+                        'xlabel' : 'Time [s]',
+                        'nbins'  : 10,
+                        'range'  : (0.0, 200.0)},
+    'conflict_cpa'   : {'title'  : 'Number of conflicts',
+                        'xlabel' : 'CPA Distance [NM]',
+                        'nbins'  : 5,
+                        'range'  : (0.0, 5.0)},
+    'conflict_time'  : {'title'  : 'Time in conflict',
+                        'xlabel' : 'Time [s]',
+                        'nbins'  : 15,
+                        'range'  : (0.0, 300.0)},
+    'min_separation' : {'title'  : 'Minimum separation of all pairs',
+                        'xlabel' : 'Minimum separation [NM]',
+                        'nbins'  : 20,
+                        'range'  : (0.0, 20.0)},
+    }
+
+############################################################
+# The values that go into each histogram
+def path_deviation_values(path_deviation):
+    '''The maximum path deviation of each aircraft that deviates [NM]'''
+    max_path_deviation = [ m2nm(deviation.max()) for deviation in path_deviation]
+
+    return [ deviation for deviation in max_path_deviation if deviation>0.01]
+
+def speed_change_values(cmd_change):
+    '''The largest speed change commands [kts]'''
+    spd = numpy.array([spd for (spd,hdg) in cmd_change])
+
+    return ms2kts(spd[spd>0.01]).tolist()
+
+def heading_change_values(cmd_change):
+    '''The largest heading change commands [deg]'''
+    hdg = numpy.array([hdg for (spd,hdg) in cmd_change])
+
+    return rad2deg(hdg[hdg>0.01]).tolist()
+
+def state_change_values(state_change):
+    '''The largest state change commands [kts]'''
+    state = numpy.array(state_change)
+
+    return ms2kts(state[state>0.01]).tolist()
+
+def cpa_values(pair_data):
+    '''The CPA distances of LOS or conflict pairs [NM]'''
+    return [ m2nm(pair['cpa']) for pair in pair_data ]
+
+def duration_values(pair_data):
+    '''The time LOS or conflict pairs spend in LOS or conflict [s]'''
+    return [ pair['time'][-1] - pair['time'][0] for pair in pair_data ]
+
+############################################################
+# Accumulators
+class Histogram:
+    '''Counts of values in fixed bins
+
+    Values outside the range are counted as underflow or overflow, so the
+    totals stay exact. Two histograms with the same bins can be merged in
+    any order.
+    '''
+
+    def __init__(self, nbins, range):
+        self.nbins     = nbins
+        self.range     = tuple(range)
+        self.edges     = numpy.linspace(range[0], range[1], nbins + 1)
+        self.counts    = numpy.zeros(nbins, dtype=numpy.int64)
+        self.underflow = 0
+        self.overflow  = 0
+        self.n         = 0
+        self.total     = 0.0
+        self.total_sq  = 0.0
+        self.min       = numpy.inf
+        self.max       = -numpy.inf
+
+    def update(self, values):
+        '''Add a collection of values'''
+        values = numpy.asarray(values, dtype=numpy.float64)
+
+        if not values.size:
+            return
+
+        (counts, _) = numpy.histogram(values, bins=self.edges)
+
+        self.counts    += counts
+        self.underflow += int((values < self.range[0]).sum())
+        self.overflow  += int((values > self.range[1]).sum())
+        self.n         += values.size
+        self.total     += values.sum()
+        self.total_sq  += (values ** 2).sum()
+        self.min        = min(self.min, values.min())
+        self.max        = max(self.max, values.max())
+
+    def merge(self, other):
+        '''Add the counts of another histogram with the same bins'''
+        if (self.nbins, self.range) != (other.nbins, other.range):
+            raise ValueError('Cannot merge histograms with different bins')
+
+        self.counts    += other.counts
+        self.underflow += other.underflow
+        self.overflow  += other.overflow
+        self.n         += other.n
+        self.total     += other.total
+        self.total_sq  += other.total_sq
+        self.min        = min(self.min, other.min)
+        self.max        = max(self.max, other.max)
+
+        return self
+
+    def mean(self):
+        '''The mean of all values'''
+        return self.total / self.n if self.n else numpy.nan
+
+    def std(self):
+        '''The standard deviation of all values'''
+        if not self.n:
+            return numpy.nan
+
+        return numpy.sqrt(max(self.total_sq / self.n - self.mean() ** 2, 0.0))
+
+    def summary(self):
+        '''A dictionary with the summary statistics'''
+        return {'n'         : self.n,
+                'mean'      : self.mean(),
+                'std'       : self.std(),
+                'min'       : self.min,
+                'max'       : self.max,
+                'underflow' : self.underflow,
+                'overflow'  : self.overflow}
+
+    def to_dict(self):
+        '''Convert to a dictionary that can be stored as json'''
+        return {'nbins'     : self.nbins,
+                'range'     : list(self.range),
+                'counts'    : self.counts.tolist(),
+                'underflow' : self.underflow,
+                'overflow'  : self.overflow,
+                'n'         : self.n,
+                'total'     : self.total,
+                'total_sq'  : self.total_sq,
+                'min'       : self.min if self.n else None,
+                'max'       : self.max if self.n else None}
+
+    @classmethod
+    def from_dict(cls, data):
+        '''Create a histogram from the output of to_dict'''
+        histogram = cls(data['nbins'], data['range'])
+
+        histogram.counts    = numpy.array(data['counts'], dtype=numpy.int64)
+        histogram.underflow = data['underflow']
+        histogram.overflow  = data['overflow']
+        histogram.n         = data['n']
+        histogram.total     = data['total']
+        histogram.total_sq  = data['total_sq']
+
+        if histogram.n:
+            histogram.min = data['min']
+            histogram.max = data['max']
+
+        return histogram
+
+
+def create_histograms():
+    '''Create an empty histogram for each of the HISTOGRAMS'''
+    return dict((name, Histogram(definition['nbins'], definition['range']))
+                for (name, definition) in HISTOGRAMS.items())
+
+def update_histograms(histograms, path_deviation=(), cmd_change=(),
+                      state_change=(), los_data=(), conflict_data=()):
+    '''Add the results of one run to the histograms'''
+    histograms['path_deviation'].update(path_deviation_values(path_deviation))
+    histograms['speed_change'].update(speed_change_values(cmd_change))
+    histograms['heading_change'].update(heading_change_values(cmd_change))
+    histograms['state_change'].update(state_change_values(state_change))
+    histograms['los_cpa'].update(cpa_values(los_data))
+    histograms['los_time'].update(duration_values(los_data))
+    histograms['conflict_cpa'].update(cpa_values(conflict_data))
+    histograms['conflict_time'].update(duration_values(conflict_data))
+
+def merge_histograms(histograms, other):
+    '''Merge the histograms of another run or process into histograms'''
+    for (name, histogram) in other.items():
+        histograms[name].merge(histogram)
+
+    return histograms
+
+def save_histograms(histograms, filename):
+    '''Write the histograms to a json file'''
+    with open(filename, 'w') as json_file:
+        json.dump(dict((name, histogram.to_dict())
+                       for (name, histogram) in histograms.items()),
+                  json_file)
+
+def load_histograms(filename):
+    '''Read histograms that were written with save_histograms'''
+    with open(filename) as json_file:
+        return dict((name, Histogram.from_dict(data))
+                    for (name, data) in json.load(json_file).items())
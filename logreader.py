@@ -1,8 +1,9 @@
 '''Read the logdata from a csv file into an aircraft structure'''
 
 import csv
+import os
 import numpy as np
-from acfttrace import AircraftTrace
+from acfttrace import AircraftTrace, FULL_PRECISION, VARIABLE_NAMES
 import math
 
 
@@ -62,58 +63,122 @@ def wgs84_to_ecef(lla, unit="rad"):
     return np.array([[x], [y], [z]])
 
 
-def _parse_aircraft_data(logfile, headings, fname):
-    '''Convert the data into an aircraft structure'''
+def _parse_row(r, fname):
+    '''Convert a row of the csv file into a callsign, time and state'''
+    pos = wgs84_to_ecef((float(r[3]), float(r[4]), float(r[5])), unit="deg")
 
-    # Loop through all the lines in the csv file and append the states
-    # to the correct aircraft
-    csvreader = csv.reader(logfile)
+    posx, posy, posz, alt = pos[0][0], pos[1][0], pos[2][0], float(r[5])
+    callsign, time, psi, tas, cas, sel_hdg, sel_spd = r[1], float(r[0]), float(r[7]), float(r[9]), float(r[13]),\
+                                                     float(r[8]), float(r[9])
 
+    # Unwanted stuff
+    scenario, nd_range, nd_mode = fname, int(40), int(3)
+    state = [float(posx), float(posy), float(posz), alt, psi, tas, cas, sel_hdg, sel_spd, nd_range, nd_mode]
+
+    return callsign, time, state
+
+
+def _iter_chunks(logfile, headings, fname, chunk_size):
+    '''Parse the rows of an open file in chunks of (callsigns, data)'''
     hlen = len(headings)
     callsigns = []
     data = []
-    for row in csvreader:
+    for row in csv.reader(logfile):
         if not hlen == len(row):
             break
-        callsigns.append(row[1])
-        data.append(row)
-    callsigns = sorted(list(set(callsigns)))  # remove duplicates and sort alpha-numerically
-    acids = {key: value for (value, key) in enumerate(callsigns)}
 
-    # Create a new list of aircraft based on the callsigns
-    aircraft = [AircraftTrace(callsign) for callsign in callsigns]
+        callsign, time, state = _parse_row(row, fname)
+        callsigns.append(callsign)
+        data.append([time] + state)
 
-    for r in data:
-        pos = wgs84_to_ecef((float(r[3]), float(r[4]), float(r[5])), unit="deg")
+        if len(data) == chunk_size:
+            yield callsigns, np.array(data)
+            callsigns = []
+            data = []
 
-        posx, posy, posz = pos[0][0], pos[1][0], pos[2][0]
-        callsign, time, psi, tas, cas, sel_hdg, sel_spd = r[1], float(r[0]), float(r[7]), float(r[9]), float(r[13]),\
-                                                         float(r[8]), float(r[9])
+    if data:
+        yield callsigns, np.array(data)
 
-        acft_id = acids[callsign]
-        # Unwanted stuff
-        scenario, nd_range, nd_mode = fname, int(40), int(3)
-        state = [float(posx), float(posy), float(posz), psi, tas, cas, sel_hdg, sel_spd, nd_range, nd_mode]
 
-        aircraft[acft_id].addDataPoint(time, state)
+def _parse_aircraft_data(logfile, headings, fname, policy=FULL_PRECISION,
+                         chunk_size=100000):
+    '''Convert the data into an aircraft structure
 
-    for acft in aircraft:
-        acft.finalize()
+    The rows are parsed in chunks and the states of each chunk are packed
+    per aircraft with the storage policy right away, so only one chunk of
+    rows is held besides the packed states.
+    '''
+    position_idx = [VARIABLE_NAMES.index(name)
+                    for name in ('posx', 'posy', 'posz')]
 
-    return aircraft
+    # The packed pieces of the states of each aircraft
+    pieces = {}
+
+    for (callsigns, data) in _iter_chunks(logfile, headings, fname,
+                                          chunk_size):
+        # Without an origin, the positions are stored relative to the first
+        # one
+        if policy.origin is None:
+            policy = policy.with_origin(tuple(data[0, position_idx]))
+
+        # Group the rows of the chunk by callsign, keeping their order
+        callsigns = np.array(callsigns)
+        order = np.argsort(callsigns, kind='mergesort')
+        callsigns = callsigns[order]
+
+        bounds = np.flatnonzero(callsigns[1:] != callsigns[:-1]) + 1
+        for (first, last) in zip(np.concatenate(([0], bounds)),
+                                 np.concatenate((bounds, [len(order)]))):
+            pieces.setdefault(callsigns[first], []).append(
+                policy.pack(data[order[first:last]]))
+
+    # Sort the aircraft alpha-numerically on their callsigns
+    return [AircraftTrace.from_records(str(callsign),
+                                       np.concatenate(pieces.pop(callsign)),
+                                       policy)
+            for callsign in sorted(pieces)]
 
 
-def parse_logfile(fname):
-    '''Parse the file and return a list of aircraft'''
-    filename = 'logs/' + fname
-    logfile = open(filename, 'r')
+def _count_rows(filename):
+    '''The number of lines after the header of a file, at least the number
+    of rows'''
+    with open(filename, 'r') as logfile:
+        return max(sum(1 for _ in logfile) - 2, 0)
 
-    headings = _strip_header(logfile)
-    aircraft = _parse_aircraft_data(logfile, headings, fname)
+
+def parse_logfile(fname, policy=FULL_PRECISION):
+    '''Parse the file and return a list of aircraft, the traces are stored
+    with the given storage policy (see acfttrace.StoragePolicy). With a
+    memory budget, the rows are counted first and a MemoryError is raised
+    before any row is parsed if the traces would not fit.'''
+    filename = os.path.join('logs', fname)
+
+    if policy.memory_budget is not None:
+        policy.check_memory(_count_rows(filename) * policy.bytes_per_state(),
+                            'The traces of {}'.format(fname))
+
+    with open(filename, 'r') as logfile:
+        headings = _strip_header(logfile)
+        aircraft = _parse_aircraft_data(logfile, headings, fname, policy)
 
     return aircraft
 
 
+def iter_log_chunks(fname, chunk_size=100000):
+    '''Parse the file in chunks of rows, for files that do not fit in memory
+
+    Yields (callsigns, data) with the callsign of each row and an array with
+    a row of AircraftTrace.VARIABLE_NAMES for each row of the file.
+    '''
+    filename = os.path.join('logs', fname)
+
+    with open(filename, 'r') as logfile:
+        headings = _strip_header(logfile)
+
+        for chunk in _iter_chunks(logfile, headings, fname, chunk_size):
+            yield chunk
+
+
 def main():
     '''Entry point when running as a script'''
 
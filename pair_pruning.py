@@ -0,0 +1,165 @@
+'''Reject aircraft pairs that never get close before any per sample work
+
+The traces are split into segments of time steps and each segment gets the
+bounding box of its positions. When the boxes of two aircraft in the same
+segment are at least the cutoff apart in x or y, the aircraft are at least
+the cutoff apart at every sample of that segment. A pair without any segment
+where the boxes come within the cutoff can not be a relevant pair. In the
+same way a pair is vertically separated in a segment when the altitude
+ranges of both aircraft are at least the vertical minimum apart.
+'''
+
+import numpy
+
+# The number of time steps per segment
+DEFAULT_SEGMENT_SIZE = 32
+
+def segment_boxes(acft, segment_size=DEFAULT_SEGMENT_SIZE):
+    '''The (xmin, xmax, ymin, ymax) box of each segment of a trace, an
+    (n_segments, 4) array, the last segment can be shorter'''
+    posx = acft.column('posx')
+    posy = acft.column('posy')
+
+    starts = numpy.arange(0, len(posx), segment_size)
+
+    return numpy.column_stack((numpy.minimum.reduceat(posx, starts),
+                               numpy.maximum.reduceat(posx, starts),
+                               numpy.minimum.reduceat(posy, starts),
+                               numpy.maximum.reduceat(posy, starts)))
+
+def _boxes_close(box, others, cutoff):
+    '''Check per segment if the boxes of others come within the cutoff of
+    the boxes of an aircraft'''
+    # The gap between the boxes in x and y, negative if they overlap
+    gap_x = numpy.maximum(others[..., 0] - box[:, 1],
+                          box[:, 0] - others[..., 1])
+    gap_y = numpy.maximum(others[..., 2] - box[:, 3],
+                          box[:, 2] - others[..., 3])
+
+    return (gap_x < cutoff) & (gap_y < cutoff)
+
+class AltitudeBands:
+    '''The lowest and highest altitude (alt) of each aircraft per segment,
+    with the aircraft of each segment sorted by their lowest altitude'''
+
+    def __init__(self, aircraft, segment_size=DEFAULT_SEGMENT_SIZE):
+        alt    = [acft.column('alt') for acft in aircraft]
+        starts = numpy.arange(0, len(alt[0]) if alt else 0, segment_size)
+
+        self.lowest  = numpy.array([numpy.minimum.reduceat(z, starts)
+                                    for z in alt]).reshape(-1, len(starts))
+        self.highest = numpy.array([numpy.maximum.reduceat(z, starts)
+                                    for z in alt]).reshape(-1, len(starts))
+
+        self.order         = numpy.argsort(self.lowest, axis=0)
+        self.sorted_lowest = numpy.take_along_axis(self.lowest, self.order,
+                                                   axis=0)
+
+    def close_pairs(self, pz_height):
+        '''The (idx1, idx2) pairs of aircraft whose altitudes come within
+        pz_height in any segment, with a boolean per segment'''
+        (n_aircraft, n_segments) = self.lowest.shape
+
+        (first, second, segment_ids) = ([], [], [])
+
+        for segment in range(n_segments):
+            order = self.order[:, segment]
+
+            # The aircraft after one in the sorted order are not lower, they
+            # are close if they are less than pz_height above its highest
+            # altitude
+            ends = numpy.searchsorted(self.sorted_lowest[:, segment],
+                                      self.highest[order, segment] + pz_height,
+                                      'left')
+
+            # Each aircraft is paired with the sorted positions after it up
+            # to its end
+            after  = numpy.arange(1, n_aircraft + 1)
+            counts = numpy.maximum(ends - after, 0)
+            others = (numpy.arange(counts.sum()) +
+                      numpy.repeat(after - numpy.cumsum(counts) + counts,
+                                   counts))
+
+            first.append(numpy.repeat(order, counts))
+            second.append(order[others])
+            segment_ids.append(numpy.repeat(segment, len(others)))
+
+        if not first:
+            return {}
+
+        (first, second) = (numpy.concatenate(first), numpy.concatenate(second))
+        idx1 = numpy.minimum(first, second)
+        idx2 = numpy.maximum(first, second)
+
+        # A row of segment booleans for each pair that is close at all
+        (pairs, rows) = numpy.unique(idx1 * n_aircraft + idx2,
+                                     return_inverse=True)
+
+        close = numpy.zeros((len(pairs), n_segments), dtype=bool)
+        close[rows, numpy.concatenate(segment_ids)] = True
+
+        return dict(((pair // n_aircraft, pair % n_aircraft), segments)
+                    for (pair, segments) in zip(pairs.tolist(), close))
+
+def prune_pairs(aircraft, cutoff, segment_size=DEFAULT_SEGMENT_SIZE,
+                pz_height=None):
+    '''Find the pairs and segments that can come within the cutoff
+
+    All aircraft need to be sampled at the same time steps. With a
+    pz_height, only the segments where the altitudes come within pz_height
+    are checked, pairs are first selected with the AltitudeBands. Returns a
+    list of (acft1, acft2, segments) with a boolean per segment for the
+    pairs that are kept, and a dictionary with the number of rejected pairs
+    and pair segments.
+    '''
+    n_points = set(acft.n_points() for acft in aircraft)
+    if len(n_points) > 1:
+        raise ValueError('All aircraft need the same number of points')
+
+    boxes = numpy.array([segment_boxes(acft, segment_size)
+                         for acft in aircraft])
+
+    candidates = []
+    n_segments = 0
+
+    n_pairs = len(aircraft) * (len(aircraft) - 1) // 2
+    n_vertical_rejected = 0
+
+    if pz_height is None:
+        for idx in range(len(aircraft) - 1):
+            close = _boxes_close(boxes[idx], boxes[idx + 1:], cutoff)
+            n_segments += close.sum()
+
+            for other in numpy.flatnonzero(close.any(axis=1)):
+                candidates.append((aircraft[idx], aircraft[idx + 1 + other],
+                                   close[other]))
+    else:
+        vertical = AltitudeBands(aircraft, segment_size).close_pairs(pz_height)
+        n_vertical_rejected = n_pairs - len(vertical)
+
+        for (idx1, idx2) in sorted(vertical):
+            close = (vertical[(idx1, idx2)] &
+                     _boxes_close(boxes[idx1], boxes[idx2], cutoff))
+            n_segments += close.sum()
+
+            if close.any():
+                candidates.append((aircraft[idx1], aircraft[idx2], close))
+
+    n_pair_segments = n_pairs * boxes.shape[1] if len(aircraft) else 0
+
+    report = {'n_pairs'            : n_pairs,
+              'n_rejected'         : n_pairs - len(candidates),
+              'n_vertical_rejected': n_vertical_rejected,
+              'n_segments'         : n_pair_segments,
+              'n_segments_rejected': n_pair_segments - n_segments,
+              'pair_rejection'     : (float(n_pairs - len(candidates)) /
+                                      n_pairs if n_pairs else 0.0),
+              'segment_rejection'  : (float(n_pair_segments - n_segments) /
+                                      n_pair_segments
+                                      if n_pair_segments else 0.0)}
+
+    return (candidates, report)
+
+def segment_mask(segments, n_points, segment_size=DEFAULT_SEGMENT_SIZE):
+    '''Expand a boolean per segment into a boolean per sample'''
+    return numpy.repeat(segments, segment_size)[:n_points]
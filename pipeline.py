@@ -0,0 +1,307 @@
+#!/usr/bin/env python2
+'''Run the post-processing of several log files as a pipeline of stages
+
+Parsing runs in a separate process ahead of the analysis, the analysis runs
+in this process and the xml and plot output is written by a pool of
+background workers. The stages are connected by bounded queues, so a slow
+stage holds back the stages before it instead of filling up memory.
+'''
+
+import collections
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import Queue
+
+import BSpostprocessing
+import complexity
+import plot_functions
+
+from acfttrace import FULL_PRECISION
+from data_reducer import _write_reduced
+from logreader import parse_logfile
+from tools import nm2m
+
+# Marks the end of the stream of parsed files
+_END = None
+
+class StageMetrics:
+    '''Counters of the work and waiting time of a stage'''
+
+    def __init__(self, name):
+        self.name       = name
+        self.items      = 0
+        self.busy       = 0.0
+        self.wait_input = 0.0
+        self.wait_output = 0.0
+
+    def report(self):
+        '''A line with the metrics of this stage'''
+        return ('{name:10s} items: {items:4d}  busy: {busy:8.2f} s  '
+                'starved: {wait_input:8.2f} s  '
+                'blocked: {wait_output:8.2f} s').format(**vars(self))
+
+class PipelineRunner:
+    '''Parse, analyse and export a list of log files with overlapping stages
+
+    queue_depth is the number of parsed files that may wait for the
+    analysis and the number of output tasks per worker that may wait to be
+    written, n_workers the number of output processes. The time a stage
+    spends waiting on a full queue is reported as blocked, the time it waits
+    on an empty queue as starved. The busy time of the output stage is the
+    time spent waiting for the last output after the analysis is done.
+    The traces are parsed with the given storage policy. If a catalog (see
+    catalog.Catalog) is given, the traces and results of each file are added
+    to it under the base name of the file. With a pz_height the LOS and
+    conflicts are checked in 3-D. With complexity, the traffic complexity
+    series of each file (see complexity.py) is written next to its xml files
+    as <name>_complexity.csv and plotted with the other plots.
+
+    Files that fail to parse and output tasks that fail are skipped and
+    kept in failures, an error in the analysis stops the run.
+    '''
+
+    def __init__(self, queue_depth=2, n_workers=2, output_dir='output',
+                 plot_dir=None, write_groups=True, cutoff=nm2m(20.0),
+                 pz_radius=nm2m(5.0), stride=10, policy=FULL_PRECISION,
+                 catalog=None, pz_height=None, complexity=False):
+        self.queue_depth  = queue_depth
+        self.n_workers    = n_workers
+        self.output_dir   = output_dir
+        self.plot_dir     = plot_dir
+        self.write_groups = write_groups
+        self.cutoff       = cutoff
+        self.pz_radius    = pz_radius
+        self.stride       = stride
+        self.policy       = policy
+        self.catalog      = catalog
+        self.pz_height    = pz_height
+        self.complexity   = complexity
+
+        self.metrics = collections.OrderedDict(
+            (name, StageMetrics(name))
+            for name in ['parse', 'analysis', 'output'])
+
+    def _put(self, parse_queue, item, stop):
+        '''Queue an item, gives up and returns False once stop is set'''
+        while not stop.is_set():
+            try:
+                parse_queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+
+        return False
+
+    def _parse_stage(self, filenames, parse_pool, parse_queue, stop):
+        '''Parse the files in a worker process and queue the results, until
+        all files are parsed or stop is set'''
+        metrics = self.metrics['parse']
+
+        try:
+            for filename in filenames:
+                if stop.is_set():
+                    return
+
+                t_begin = time.time()
+                try:
+                    aircraft = parse_pool.apply(parse_logfile,
+                                               (filename, self.policy))
+                except Exception:
+                    self.failures.append((filename, traceback.format_exc()))
+                    continue
+                finally:
+                    metrics.busy += time.time() - t_begin
+
+                metrics.items += 1
+
+                t_begin = time.time()
+                queued = self._put(parse_queue, (filename, aircraft), stop)
+                metrics.wait_output += time.time() - t_begin
+
+                if not queued:
+                    return
+        finally:
+            self._put(parse_queue, _END, stop)
+
+    def _submit_output(self, output_pool, pending, function, task):
+        '''Hand a task to the output workers, wait for the oldest task when
+        too many are outstanding'''
+        metrics = self.metrics['output']
+
+        if len(pending) >= self.queue_depth * self.n_workers:
+            t_begin = time.time()
+            self._collect_output(pending.popleft())
+            self.metrics['analysis'].wait_output += time.time() - t_begin
+
+        pending.append(output_pool.apply_async(function, (task,)))
+        metrics.items += 1
+
+    def _collect_output(self, result):
+        '''Wait for an output task and keep its failure, if any'''
+        (filename, error) = result.get()
+
+        if error:
+            self.failures.append((filename, error))
+
+    def _analyse(self, filename, aircraft, output_pool, pending):
+        '''Calculate the statistics of one file and submit its output'''
+        results = BSpostprocessing.analyse_run(aircraft, self.cutoff,
+                                               self.pz_radius, self.pz_height)
+
+        path_deviation = results['path_deviation']
+        cmd_change     = results['cmd_change']
+        los_data       = results['los']
+        conflict_data  = results['conflicts']
+
+        basename = os.path.splitext(os.path.basename(filename))[0]
+
+        if self.catalog is not None:
+            self.catalog.add_run(basename, aircraft, los_data, conflict_data,
+                                 (path_deviation, cmd_change,
+                                  results['state_change']))
+
+        if self.write_groups:
+            groups = BSpostprocessing.group_pairs(results['relevant_pairs'],
+                                                  self.cutoff)
+
+            # The groups are reduced here and written by the output workers
+            BSpostprocessing.write_groups(
+                groups, aircraft,
+                output_prefix=os.path.join(self.output_dir,
+                                           basename + '_group'),
+                stride=self.stride,
+                submit=lambda task: self._submit_output(
+                    output_pool, pending, _write_reduced, task))
+
+        if self.complexity:
+            series = complexity.complexity_series(
+                complexity.iter_fleet_steps(aircraft),
+                pz_radius=self.pz_radius)
+
+            complexity.write_complexity(series, os.path.join(
+                self.output_dir, basename + '_complexity.csv'))
+
+        if self.plot_dir is not None:
+            plot_jobs = [('plot_path_deviation', path_deviation),
+                         ('plot_largest_cmd_change', cmd_change),
+                         ('plot_los', los_data),
+                         ('plot_los_time', los_data),
+                         ('plot_conflicts_time', conflict_data)]
+
+            if self.complexity:
+                plot_jobs.append(('plot_complexity', series))
+
+            self._submit_output(output_pool, pending,
+                                plot_functions.render_task,
+                                (os.path.join(self.plot_dir, basename),
+                                 plot_jobs))
+
+        return {'filename'  : filename,
+                'los'       : los_data,
+                'conflicts' : conflict_data}
+
+    def run(self, filenames):
+        '''Process all files, returns the LOS and conflict data per file'''
+        if ((self.write_groups or self.complexity) and
+                not os.path.isdir(self.output_dir)):
+            os.makedirs(self.output_dir)
+
+        self.failures = []
+
+        parse_queue = Queue.Queue(maxsize=self.queue_depth)
+        parse_pool  = multiprocessing.Pool(1)
+        output_pool = multiprocessing.Pool(self.n_workers)
+        pending     = collections.deque()
+        stop        = threading.Event()
+
+        parser = threading.Thread(target=self._parse_stage,
+                                  args=(filenames, parse_pool, parse_queue,
+                                        stop))
+        parser.daemon = True
+        parser.start()
+
+        metrics = self.metrics['analysis']
+        results = []
+
+        try:
+            while True:
+                t_begin = time.time()
+                item = parse_queue.get()
+                metrics.wait_input += time.time() - t_begin
+
+                if item is _END:
+                    break
+
+                (filename, aircraft) = item
+
+                t_begin = time.time()
+                results.append(self._analyse(filename, aircraft,
+                                             output_pool, pending))
+                metrics.busy  += time.time() - t_begin
+                metrics.items += 1
+
+            # Wait for the remaining output
+            t_begin = time.time()
+            while pending:
+                self._collect_output(pending.popleft())
+            self.metrics['output'].busy += time.time() - t_begin
+
+            if self.catalog is not None:
+                self.catalog.flush()
+        finally:
+            # After an error the parser may wait for room in the queue
+            stop.set()
+            while parser.is_alive():
+                try:
+                    parse_queue.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+            parser.join()
+
+            parse_pool.close()
+            output_pool.close()
+            parse_pool.join()
+            output_pool.join()
+
+        self.report()
+
+        return results
+
+    def report(self):
+        '''Print the metrics of all stages and the failed files and output'''
+        print
+        print 'Pipeline metrics:'
+        for metrics in self.metrics.values():
+            print metrics.report()
+
+        if self.failures:
+            print
+            print '{} files or output tasks failed:'.format(
+                len(self.failures))
+            for (filename, error) in self.failures:
+                print filename
+                print error
+
+
+def main():
+    '''Entry point for this application when it's run as a script'''
+
+    # All arguments are log files
+    filenames = sys.argv[1:]
+
+    if not filenames:
+        print('Provide one or more log files!')
+        return 1
+
+    PipelineRunner(plot_dir='plots').run(filenames)
+
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(main())
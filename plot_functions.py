@@ -1,10 +1,52 @@
 '''A collection of functions to plot the data'''
 
-import matplotlib.pyplot as plt
+import multiprocessing
+import os
+import sys
+import traceback
 
-from tools import m2nm, nm2m, ms2kts, rad2deg
+from tools import m2nm, ms2kts
+from histograms import (HISTOGRAMS, path_deviation_values,
+                        speed_change_values, heading_change_values,
+                        state_change_values, cpa_values, duration_values)
 
-def plot_histogram(data,title,xlabel,nbins,ylim=10,range=None):
+# Directory the figures are saved to in headless mode, None shows them
+_output_dir = None
+
+def _pyplot():
+    '''Import pyplot when it is first needed, with a non-interactive backend
+    in headless mode'''
+    import matplotlib
+
+    # The backend can only be selected before pyplot is imported
+    if _output_dir is not None and 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+
+    import matplotlib.pyplot
+
+    return matplotlib.pyplot
+
+def use_headless(output_dir):
+    '''Save every figure as an image in output_dir instead of showing it'''
+    global _output_dir
+
+    # Workers may create the same directory at the same time
+    try:
+        os.makedirs(output_dir)
+    except OSError:
+        if not os.path.isdir(output_dir):
+            raise
+
+    _output_dir = output_dir
+
+def _figure_filename(title):
+    '''The image file of a figure in headless mode'''
+    return os.path.join(_output_dir,
+                        title.lower().replace(' ', '_') + '.png')
+
+def plot_histogram(data,title,xlabel,nbins,ylim=10,range=None,weights=None):
+
+    plt = _pyplot()
 
     if not range:
         range = (data.min(),data.max())
@@ -13,6 +55,7 @@ def plot_histogram(data,title,xlabel,nbins,ylim=10,range=None):
     (n,bins,patches) = plt.hist(data,
                                 bins=nbins,
                                 range=range,
+                                weights=weights,
                                 rwidth=0.7)
 
     plt.ylim([0,ylim])
@@ -21,103 +64,180 @@ def plot_histogram(data,title,xlabel,nbins,ylim=10,range=None):
     plt.title(title)
     plt.xlabel(xlabel)
 
-def plot_path_deviation(path_deviation):
+    if _output_dir is not None:
+        plt.savefig(_figure_filename(title))
+        plt.close()
 
-    max_path_deviation = [ m2nm(deviation.max()) for deviation in path_deviation]
+def _plot_values(name, values):
+    '''Plot a histogram of values with the bins of one of the HISTOGRAMS'''
+    if values:
+        plot_histogram(values, **HISTOGRAMS[name])
 
-    max_path_deviation = [ deviation for deviation in max_path_deviation if deviation>0.01]
+def plot_path_deviation(path_deviation):
 
-    if max_path_deviation:
-        plot_histogram(max_path_deviation,
-                       title  = 'Path deviation',
-                       xlabel = 'Path deviation [NM]',
-                       nbins  = 20,
-                       range  = (0,20.0))
+    _plot_values('path_deviation', path_deviation_values(path_deviation))
 
 def plot_largest_cmd_change(cmd_change):
     
-    spd_changes = [ms2kts(spd)  for (spd,hdg) in cmd_change if spd>0.01]
-    hdg_changes = [rad2deg(hdg) for (spd,hdg) in cmd_change if hdg>0.01]
-
-    if spd_changes:
-        plot_histogram(spd_changes,
-                       title  = 'Largest speed change commands',
-                       xlabel = 'Speed change command [kts]',
-                       nbins  = 10,
-                       range  = (0,100.0) )
-
-    if hdg_changes:
-        plot_histogram(hdg_changes,
-                       title  = 'Largest heading change commands',
-                       xlabel = 'Heading change command [deg]',
-                       nbins  = 18,
-                       range  = (0,180.0) )
+    _plot_values('speed_change', speed_change_values(cmd_change))
+    _plot_values('heading_change', heading_change_values(cmd_change))
 
 def plot_largest_cmd_state_change(state_change):
 
-    state_change = [ms2kts(state) for state in state_change if state>0.01]
-
-    if state_change:
-        plot_histogram(state_change,
-                       title  = 'Largest state change commands',
-                       xlabel = 'State change command [kts]',
-                        nbins  = 15,
-                       range  = (0,300.0) )
+    _plot_values('state_change', state_change_values(state_change))
     
 
 def plot_los(los_data):
     '''Make a histogram of the LOS data'''
     
-    los_cpas = [ m2nm(pair['cpa']) for pair in los_data ]
-
-    if los_cpas:
-        plot_histogram(los_cpas,
-                       title  = 'Number of LOS',
-                       xlabel = 'CPA Distance [NM]',
-                        nbins  = 5,
-                       range=(0.0,5.0))
+    _plot_values('los_cpa', cpa_values(los_data))
 
     
 
 def plot_los_time(los_data):
     '''Make a histogram of the LOS times'''
 
-    los_time = [ pair['time'][-1] - pair['time'][0] for pair in los_data ]
-
-    if los_time:
-        plot_histogram(los_time,
-                       title  = 'Time in LOS',
-                       xlabel = 'Time [s]',
-                        nbins  = 10,
-                       range=(0.0, 200.0))
+    _plot_values('los_time', duration_values(los_data))
 
 
 def plot_conflicts(conflict_data):
     '''Make a histogram of the conflict data'''
     
-    conflict_cpas = [ m2nm(pair['cpa']) for pair in conflict_data ]
-
-    if conflict_cpas:
-        plot_histogram(conflict_cpas,
-                       title  = 'Number of conflicts',
-                       xlabel = 'CPA Distance [NM]',
-                        nbins  = 5,
-                       range=(0.0,5.0))
+    _plot_values('conflict_cpa', cpa_values(conflict_data))
     
 
 def plot_conflicts_time(conflict_data):
     '''Make a histogram of the LOS times'''
 
-    conflicts_time = [ pair['time'][-1] - pair['time'][0] for pair in conflict_data ]
+    _plot_values('conflict_time', duration_values(conflict_data))
+
+
+def plot_accumulated(histograms):
+    '''Plot accumulated histograms from their counts'''
+
+    for (name, histogram) in sorted(histograms.items()):
+        if not histogram.counts.any():
+            continue
+
+        edges   = histogram.edges
+        centers = (edges[:-1] + edges[1:]) / 2.0
+
+        plot_histogram(centers,
+                       weights = histogram.counts,
+                       ylim    = max(10, histogram.counts.max()),
+                       **HISTOGRAMS[name])
+
+def plot_density_map(density_map, title='Traffic density'):
+    '''Show a density map as an image with the LOS locations on top'''
+
+    plt = _pyplot()
+
+    # Plot north (x) up and east (y) to the right
+    (xmin, xmax, ymin, ymax) = [m2nm(value) for value in density_map.extent]
+
+    plt.figure()
+    plt.imshow(density_map.counts,
+               origin='lower',
+               extent=(ymin, ymax, xmin, xmax),
+               aspect='equal',
+               interpolation='nearest',
+               cmap='viridis')
+    plt.colorbar()
+
+    if len(density_map.los_positions):
+        plt.scatter(m2nm(density_map.los_positions[:, 1]),
+                    m2nm(density_map.los_positions[:, 0]),
+                    marker='x', color='red', label='LOS')
+        plt.legend()
+
+    plt.title(title)
+    plt.xlabel('y [NM]')
+    plt.ylabel('x [NM]')
+
+    if _output_dir is not None:
+        plt.savefig(_figure_filename(title))
+        plt.close()
+
+
+def plot_complexity(series, title='Traffic complexity'):
+    '''Plot the traffic complexity series (see complexity.py) against time'''
+
+    plt = _pyplot()
+
+    t = series['t']
+
+    (figure, axes) = plt.subplots(4, 1, sharex=True)
+
+    axes[0].plot(t, series['n_aircraft'])
+    axes[0].set_ylabel('Aircraft')
+
+    axes[1].plot(t, series['density'])
+    axes[1].set_ylabel('Neighbours')
+
+    axes[2].plot(t, series['n_conflicts'], label='Conflicts')
+    axes[2].plot(t, series['n_los'], label='LOS')
+    axes[2].set_ylabel('Pairs')
+    axes[2].legend()
+
+    axes[3].plot(t, ms2kts(series['closing_speed']))
+    axes[3].set_ylabel('Closing [kts]')
+    axes[3].set_xlabel('Time [s]')
+
+    axes[0].set_title(title)
+
+    if _output_dir is not None:
+        plt.savefig(_figure_filename(title))
+        plt.close(figure)
 
-    if conflicts_time:
-        plot_histogram(conflicts_time,
-                       title  = 'Time in conflict',
-                       xlabel = 'Time [s]',
-                       nbins  = 15,
-                       range  = (0.0,300.0))
 
-        
 def show():
-    '''Show all plots'''
-    plt.show()
+    '''Show all plots, in headless mode they are already saved'''
+    if _output_dir is None:
+        _pyplot().show()
+
+def render_task(task):
+    '''Render an (output_dir, jobs) task, with a list of (plot function
+    name, data) jobs, to image files in output_dir. Runs in a worker
+    process, returns (output_dir, error) with the traceback as error if a
+    plot failed.'''
+    (output_dir, jobs) = task
+
+    try:
+        use_headless(output_dir)
+
+        for (plot_name, data) in jobs:
+            globals()[plot_name](data)
+    except Exception:
+        return (output_dir, traceback.format_exc())
+
+    return (output_dir, None)
+
+def render_plots(jobs, output_dir, n_workers=None):
+    '''Render a list of (plot function name, data) jobs to image files in
+    output_dir using a pool of worker processes, returns a list of (plot
+    function name, error) tuples for the plots that failed'''
+
+    failures = []
+
+    pool = multiprocessing.Pool(n_workers)
+
+    try:
+        results = pool.imap(render_task,
+                            [(output_dir, [job]) for job in jobs])
+
+        for ((plot_name, _), (_, error)) in zip(jobs, results):
+            if error:
+                failures.append((plot_name, error))
+
+            print 'Rendered {}{}'.format(plot_name,
+                                         ' FAILED' if error else '')
+    finally:
+        pool.close()
+        pool.join()
+
+    for (plot_name, error) in failures:
+        print
+        print plot_name
+        print error
+
+    return failures
@@ -0,0 +1,237 @@
+#!/usr/bin/env python2
+'''A quick look at a run from a sample of the time steps and pairs
+
+All pairs are screened on a coarse grid of time steps. Between two coarse
+steps the separation of a pair cannot change by more than twice the largest
+ground speed times half the step, so a pair whose coarse separation stays
+above pz_radius plus that bound can not have a LOS. All other pairs are
+refined at the full resolution, the LOS count is exact. Conflicts of the
+pairs that are not refined are estimated from a random sample of them, which
+is also checked at the full resolution so a conflict between two coarse
+steps is not missed. The path deviation is estimated from a random sample of
+the aircraft. Counts that come from a sample are reported with a confidence
+interval.
+'''
+
+import itertools
+import numpy
+
+from BSpostprocessing import (calculate_distance, calculate_future_cpa,
+                              calculate_path_deviation)
+from histograms import HISTOGRAMS, Histogram, path_deviation_values
+from logreader import parse_logfile
+from tools import m2nm, nm2m
+
+# The normal quantiles of the supported confidence levels
+Z_VALUES = {0.90: 1.645, 0.95: 1.960, 0.99: 2.576}
+
+def wilson_interval(k, n, confidence=0.95):
+    '''The Wilson score interval of a proportion of k out of n, k can be an
+    array'''
+    z = Z_VALUES[confidence]
+    k = numpy.asarray(k, dtype=numpy.float64)
+
+    if not n:
+        return (numpy.zeros_like(k), numpy.ones_like(k))
+
+    p      = k / n
+    center = (p + z ** 2 / (2.0 * n)) / (1.0 + z ** 2 / n)
+    half   = (z * numpy.sqrt(p * (1.0 - p) / n + z ** 2 / (4.0 * n ** 2))
+              / (1.0 + z ** 2 / n))
+
+    return (numpy.maximum(center - half, 0.0), numpy.minimum(center + half, 1.0))
+
+def estimate_count(k, n, population, confidence=0.95):
+    '''Estimate how many of a population have a property that k out of a
+    sample of n have, as an {'estimate', 'low', 'high'} dictionary'''
+    if n == population:
+        return {'estimate' : k, 'low' : k, 'high' : k}
+
+    (low, high) = wilson_interval(k, n, confidence)
+
+    return {'estimate' : population * float(k) / n if n else 0.0,
+            'low'      : population * low,
+            'high'     : population * high}
+
+def histogram_intervals(histogram, n, population, confidence=0.95):
+    '''The estimated counts of each bin for the whole population, with the
+    low and high bounds, when histogram holds the values of a sample of n'''
+    if n == population:
+        return (histogram.counts, histogram.counts, histogram.counts)
+
+    (low, high) = wilson_interval(histogram.counts, n, confidence)
+
+    return (histogram.counts * float(population) / n,
+            low * population,
+            high * population)
+
+def _create_histogram(name):
+    '''An empty histogram with the bins of one of the HISTOGRAMS'''
+    return Histogram(HISTOGRAMS[name]['nbins'], HISTOGRAMS[name]['range'])
+
+def coarse_indices(t, time_stride):
+    '''Every time_stride-th step, the last step is always included'''
+    return numpy.union1d(numpy.arange(0, len(t), time_stride), [len(t) - 1])
+
+def max_ground_speed(aircraft):
+    '''The largest horizontal speed between two samples of any aircraft'''
+    v_max = 0.0
+
+    for acft in aircraft:
+        dt = numpy.diff(acft.column('t'))
+        ds = numpy.hypot(numpy.diff(acft.column('posx')),
+                         numpy.diff(acft.column('posy')))
+
+        if (dt > 0).any():
+            v_max = max(v_max, (ds[dt > 0] / dt[dt > 0]).max())
+
+    return v_max
+
+def coarse_min_separation(aircraft, indices):
+    '''The minimum separation of each pair at the coarse steps, an (N, N)
+    array'''
+    posx = numpy.vstack([acft.column('posx')[indices] for acft in aircraft])
+    posy = numpy.vstack([acft.column('posy')[indices] for acft in aircraft])
+
+    min_separation = numpy.empty((len(aircraft), len(aircraft)))
+    min_separation.fill(numpy.inf)
+
+    # One step at a time, so only the distances of one step are in memory
+    for step in range(len(indices)):
+        distance = numpy.hypot(posx[:, step, numpy.newaxis] - posx[:, step],
+                               posy[:, step, numpy.newaxis] - posy[:, step])
+        numpy.minimum(min_separation, distance, out=min_separation)
+
+    return min_separation
+
+def quick_look(aircraft, pz_radius=nm2m(5.0), time_stride=10,
+               pair_fraction=0.1, aircraft_fraction=0.25, confidence=0.95,
+               seed=None):
+    '''Estimate the LOS and conflict counts, the minimum separation of the
+    pairs and the path deviation of the aircraft of a run
+
+    All aircraft need to be sampled at the same time steps. Returns a
+    dictionary with the estimates, see the module documentation.
+    '''
+    n_points = set(acft.n_points() for acft in aircraft)
+    if len(n_points) != 1:
+        raise ValueError('All aircraft need the same number of points')
+
+    random  = numpy.random.RandomState(seed)
+    t       = aircraft[0].column('t')
+    indices = coarse_indices(t, time_stride)
+
+    # The largest error of the separation on the coarse steps
+    dt_max = numpy.diff(t[indices]).max() if len(indices) > 1 else 0.0
+    separation_error = max_ground_speed(aircraft) * dt_max
+    threshold = pz_radius + separation_error
+
+    min_separation = coarse_min_separation(aircraft, indices)
+
+    pairs = list(itertools.combinations(range(len(aircraft)), 2))
+    near  = [pair for pair in pairs if min_separation[pair] < threshold]
+    far   = [pair for pair in pairs if min_separation[pair] >= threshold]
+
+    # The pairs that might get close are checked at the full resolution
+    n_los      = 0
+    n_conflict = 0
+    for pair in near:
+        (acft1, acft2) = (aircraft[pair[0]], aircraft[pair[1]])
+
+        distance = calculate_distance(acft1, acft2)
+        min_separation[pair] = distance.min()
+
+        n_los      += int((distance < pz_radius).any())
+        n_conflict += int((calculate_future_cpa(acft1, acft2)
+                           < pz_radius).any())
+
+    # Conflicts of the other pairs are estimated from a sample
+    n_sampled = int(numpy.ceil(pair_fraction * len(far)))
+    sampled   = [far[idx] for idx in
+                 random.choice(len(far), n_sampled, replace=False)]
+
+    n_far_conflict = 0
+    for pair in sampled:
+        (acft1, acft2) = (aircraft[pair[0]], aircraft[pair[1]])
+
+        n_far_conflict += int((calculate_future_cpa(acft1, acft2)
+                               < pz_radius).any())
+
+    far_conflicts = estimate_count(n_far_conflict, n_sampled, len(far),
+                                   confidence)
+    conflicts = dict((key, n_conflict + value)
+                     for (key, value) in far_conflicts.items())
+
+    # The separation of the far pairs is at most separation_error too large
+    separation = _create_histogram('min_separation')
+    separation.update(m2nm(numpy.array([min_separation[pair]
+                                        for pair in pairs])))
+
+    # The path deviation of a sample of the aircraft
+    n_acft_sampled = int(numpy.ceil(aircraft_fraction * len(aircraft)))
+    acft_sampled   = random.choice(len(aircraft), n_acft_sampled,
+                                   replace=False)
+
+    path_deviation = _create_histogram('path_deviation')
+    path_deviation.update(path_deviation_values(
+        [calculate_path_deviation(aircraft[idx].view(indices))
+         for idx in acft_sampled]))
+
+    return {'n_pairs'          : len(pairs),
+            'n_refined'        : len(near),
+            'n_sampled'        : n_sampled,
+            'separation_error' : separation_error,
+            'los'              : estimate_count(n_los, len(near), len(near)),
+            'conflicts'        : conflicts,
+            'min_separation'   : separation,
+            'path_deviation'   : path_deviation,
+            'path_deviation_bins' : histogram_intervals(
+                path_deviation, n_acft_sampled, len(aircraft), confidence)}
+
+def report(results):
+    '''Print the estimates of a quick look'''
+    print
+    print '{n_pairs} pairs, {n_refined} refined, {n_sampled} sampled'.format(
+        **results)
+    print 'Separation error of the coarse steps: {:.2f} NM'.format(
+        m2nm(results['separation_error']))
+
+    for name in ['los', 'conflicts']:
+        print '{:10s} {estimate:8.1f}  [{low:8.1f}, {high:8.1f}]'.format(
+            name, **results[name])
+
+    separation = results['min_separation']
+    print 'Minimum separation: mean {:.2f} NM, min {:.2f} NM'.format(
+        separation.mean(), separation.min)
+
+    (estimate, low, high) = results['path_deviation_bins']
+    edges = results['path_deviation'].edges
+    print 'Path deviation [NM]:'
+    for (idx, count) in enumerate(estimate):
+        print '{:6.1f} - {:6.1f}  {:8.1f}  [{:8.1f}, {:8.1f}]'.format(
+            edges[idx], edges[idx + 1], count, low[idx], high[idx])
+
+
+def main():
+    '''Entry point for this application when it's run as a script'''
+
+    # Check if we started with the correct arguemnts (either none or one)
+    n_args = len(sys.argv)
+
+    if n_args == 1:
+        filename = 'input.txt'
+    elif n_args == 2:
+        filename = sys.argv[1]
+    else:
+        print('Too many arguments provided!')
+        return 1
+
+    report(quick_look(parse_logfile(filename)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(main())
@@ -1,6 +1,5 @@
 '''A collection of general helper functions'''
 
-import math
 import numpy
 
 ############################################################
@@ -31,11 +30,30 @@ def kts2ms(data):
 
 def rad2deg(data):
     '''Convert radians to degrees'''
-    return math.degrees(data)
+    return numpy.degrees(data)
 
 def deg2rad(data):
     '''Convert degrees to radians'''
-    return math.radians(data)
+    return numpy.radians(data)
+
+# Conversions from the SI unit of a variable to another unit
+UNIT_CONVERSIONS = { ('m',   'nm')  : m2nm,
+                     ('m',   'ft')  : m2ft,
+                     ('m/s', 'kts') : ms2kts,
+                     ('rad', 'deg') : rad2deg }
+
+def convert_unit(data, from_unit, to_unit):
+    '''Convert data between two units'''
+    if from_unit == to_unit:
+        return data
+
+    try:
+        conversion = UNIT_CONVERSIONS[(from_unit, to_unit)]
+    except KeyError:
+        raise ValueError('Cannot convert from {} to {}'.format(from_unit,
+                                                               to_unit))
+
+    return conversion(data)
 
 ############################################################
 # Vector functions
@@ -69,16 +87,20 @@ def calculate_bounding_box(acft_trace):
 
 class BoundingBox:
     '''A class to help with bounding box calculations'''
-    def __init__(self, aircraft):
-        (xmin, xmax, ymin, ymax) = calculate_bounding_box(aircraft[0])
-        
-        self.xmin = xmin
-        self.xmax = xmax
-        self.ymin = ymin
-        self.ymax = ymax
+    def __init__(self, aircraft=(), extent=None):
+        if extent is None:
+            # Reduce the positions of all aircraft in one go
+            posx = numpy.concatenate([acft.column('posx') for acft in aircraft])
+            posy = numpy.concatenate([acft.column('posy') for acft in aircraft])
 
-        for acft in aircraft:
-            self.add_aircraft(acft)
+            extent = (posx.min(), posx.max(), posy.min(), posy.max())
+
+        (self.xmin, self.xmax, self.ymin, self.ymax) = extent
+
+    @classmethod
+    def from_extent(cls, extent):
+        '''Create a bounding box from an (xmin, xmax, ymin, ymax) extent'''
+        return cls(extent=extent)
 
     def add_aircraft(self, aircraft):
         '''Add a new aircraft and expand the bounding box if necesary'''
@@ -99,3 +121,98 @@ class BoundingBox:
         self.xmax += amount
         self.ymin -= amount
         self.ymax += amount
+
+class ExtentIndex:
+    '''The minimum and maximum position of each aircraft per block of time
+    steps, to get the extent of a time window and a set of aircraft without
+    going through all the positions again
+
+    All aircraft need to be sampled at the same time steps. Only the block
+    extents are stored, the samples at the edges of a window are read from
+    the traces.
+    '''
+    def __init__(self, aircraft, block_size=64):
+        self.aircraft   = aircraft
+        self.callsigns  = dict((acft.callsign, idx)
+                               for (idx, acft) in enumerate(aircraft))
+        self.block_size = block_size
+
+        n_points = set(acft.n_points() for acft in aircraft)
+        if len(n_points) != 1:
+            raise ValueError('All aircraft need the same number of points')
+
+        self.t = aircraft[0].column('t')
+
+        # Only complete blocks are indexed, the rest is a short scan
+        n_blocks = len(self.t) // block_size
+
+        def block_extent(acft, name):
+            blocks = acft.column(name)[:n_blocks * block_size].reshape(
+                n_blocks, block_size)
+
+            return (blocks.min(axis=1), blocks.max(axis=1))
+
+        # One aircraft at a time, only the column of one trace is copied
+        (self.block_xmin, self.block_xmax) = [
+            numpy.array(values).reshape(len(aircraft), n_blocks)
+            for values in zip(*[block_extent(acft, 'posx')
+                                for acft in aircraft])]
+        (self.block_ymin, self.block_ymax) = [
+            numpy.array(values).reshape(len(aircraft), n_blocks)
+            for values in zip(*[block_extent(acft, 'posy')
+                                for acft in aircraft])]
+
+    def extent(self, t_begin=None, t_end=None, callsigns=None):
+        '''Get the (xmin, xmax, ymin, ymax) extent of the aircraft with the
+        given callsigns (default all) between t_begin and t_end (inclusive)'''
+        begin_idx = 0 if t_begin is None else numpy.searchsorted(self.t, t_begin,
+                                                                 'left')
+        end_idx   = (len(self.t) if t_end is None else
+                     numpy.searchsorted(self.t, t_end, 'right'))
+
+        if callsigns is None:
+            rows = numpy.arange(len(self.aircraft))
+        else:
+            rows = numpy.array([self.callsigns[callsign]
+                                for callsign in callsigns])
+
+        if begin_idx >= end_idx or not len(rows):
+            raise ValueError('No positions in the time window')
+
+        # The complete blocks inside the window come from the index
+        first_block = -(-begin_idx // self.block_size)
+        last_block  = end_idx // self.block_size
+
+        xmin = []
+        xmax = []
+        ymin = []
+        ymax = []
+
+        if first_block < last_block:
+            blocks = (rows[:, numpy.newaxis],
+                      numpy.arange(first_block, last_block))
+
+            xmin.append(self.block_xmin[blocks].min())
+            xmax.append(self.block_xmax[blocks].max())
+            ymin.append(self.block_ymin[blocks].min())
+            ymax.append(self.block_ymax[blocks].max())
+
+            edges = [(begin_idx, first_block * self.block_size),
+                     (last_block * self.block_size, end_idx)]
+        else:
+            edges = [(begin_idx, end_idx)]
+
+        # Scan the parts of the window that are not a complete block
+        for (first, last) in edges:
+            if first < last:
+                posx = numpy.array([self.aircraft[row].column('posx')
+                                    [first:last] for row in rows])
+                posy = numpy.array([self.aircraft[row].column('posy')
+                                    [first:last] for row in rows])
+
+                xmin.append(posx.min())
+                xmax.append(posx.max())
+                ymin.append(posy.min())
+                ymax.append(posy.max())
+
+        return (min(xmin), max(xmax), min(ymin), max(ymax))
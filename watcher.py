@@ -0,0 +1,348 @@
+#!/usr/bin/env python2
+'''Watch a directory for new log files and process them as they arrive
+
+The logs are processed by a pool of worker processes that stay alive, so
+only the first log pays for starting python and loading numpy and
+matplotlib. A file is picked up once its size and modification time did not
+change between two scans, so files that are still being written are left
+alone. The sha1 hash of every processed file is kept in a ledger, a file
+with the same content is not processed again, also not under another name or
+after a restart. Failed files stay in the ledger too, remove their entry to
+try again.
+
+Everything is written to the output directory, the name of the results of
+a log is its base name followed by the first characters of its hash, so a
+new log with the name of an earlier one does not overwrite its results:
+
+    ledger.json             the processed files by content hash
+    status.json             the state and metrics of the watcher
+    results/<name>.json     the LOS and conflicts of a log
+    results/<name>.log      the console output of its analysis
+    <name>_group<N>.xml     the group exports
+'''
+
+import fnmatch
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import BSpostprocessing
+import plot_functions
+
+from logreader import parse_logfile
+from tools import nm2m
+
+# Time between two scans of the directory [s]
+DEFAULT_POLL_INTERVAL = 5.0
+
+# The number of characters of the hash in the names of the results
+DIGEST_PREFIX = 8
+
+def file_digest(filename, block_size=1024*1024):
+    '''The sha1 hash of the content of a file'''
+    digest = hashlib.sha1()
+
+    with open(filename, 'rb') as data_file:
+        for block in iter(lambda: data_file.read(block_size), ''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def _write_json(data, filename):
+    '''Write a json file in one step, readers never see a partial file'''
+    with open(filename + '.tmp', 'w') as json_file:
+        json.dump(data, json_file, indent=1, sort_keys=True)
+
+    os.rename(filename + '.tmp', filename)
+
+def _warm_up(plot_dir):
+    '''Prepare a worker process, load matplotlib before the first log
+    arrives if plots are made'''
+    if plot_dir is not None:
+        plot_functions.use_headless(plot_dir)
+        plot_functions._pyplot()
+
+def _pair_summary(pair_data):
+    '''The LOS or conflicts of a log in a form that can be stored as json'''
+    return [{'acft1'   : pair['acft1'],
+             'acft2'   : pair['acft2'],
+             't_start' : float(pair['time'][0]),
+             't_end'   : float(pair['time'][-1]),
+             'cpa'     : float(pair['cpa'])}
+            for pair in pair_data]
+
+def _process_log(task):
+    '''Analyse a log file and write its results, runs in a worker
+
+    Returns (filename, digest, results filename, error), the error is None
+    if the log was processed.
+    '''
+    (filename, digest, settings) = task
+
+    basename = '{}_{}'.format(os.path.splitext(os.path.basename(filename))[0],
+                              digest[:DIGEST_PREFIX])
+    results_dir = os.path.join(settings['output_dir'], 'results')
+
+    t_begin = time.time()
+    stdout  = sys.stdout
+
+    try:
+        with open(os.path.join(results_dir, basename + '.log'), 'w') as log:
+            sys.stdout = log
+
+            aircraft = parse_logfile(os.path.abspath(filename))
+
+            results = BSpostprocessing.analyse_run(
+                aircraft, settings['cutoff'], settings['pz_radius'],
+                settings['pz_height'])
+
+            los_data      = results['los']
+            conflict_data = results['conflicts']
+
+            group_files = []
+            if settings['write_groups']:
+                groups = BSpostprocessing.group_pairs(
+                    results['relevant_pairs'], settings['cutoff'])
+
+                prefix = os.path.join(settings['output_dir'],
+                                      basename + '_group')
+                BSpostprocessing.write_groups(groups, aircraft,
+                                              output_prefix=prefix)
+
+                group_files = [prefix + str(idx + 1) + '.xml'
+                               for idx in range(len(groups))]
+
+        if settings['plot_dir'] is not None:
+            (_, error) = plot_functions.render_task(
+                (os.path.join(settings['plot_dir'], basename),
+                 [('plot_path_deviation', results['path_deviation']),
+                  ('plot_largest_cmd_change', results['cmd_change']),
+                  ('plot_los', los_data),
+                  ('plot_los_time', los_data),
+                  ('plot_conflicts_time', conflict_data)]))
+
+            if error:
+                return (filename, digest, None, error)
+    except Exception:
+        return (filename, digest, None, traceback.format_exc())
+    finally:
+        sys.stdout = stdout
+
+    results = {'file'            : filename,
+               'sha1'            : digest,
+               'n_aircraft'      : len(aircraft),
+               'los'             : _pair_summary(los_data),
+               'conflicts'       : _pair_summary(conflict_data),
+               'groups'          : [group_file for group_file in group_files
+                                    if os.path.exists(group_file)],
+               'processing_time' : time.time() - t_begin}
+
+    results_filename = os.path.join(results_dir, basename + '.json')
+    _write_json(results, results_filename)
+
+    return (filename, digest, results_filename, None)
+
+class LogWatcher:
+    '''Process the logs that appear in a directory with a pool of workers
+
+    Files matching the pattern are processed with the same steps as the
+    pipeline (see pipeline.PipelineRunner), plots are only made if a plot
+    directory is given.
+    '''
+
+    def __init__(self, watch_dir, output_dir='output', n_workers=2,
+                 poll_interval=DEFAULT_POLL_INTERVAL, pattern='*.txt',
+                 plot_dir=None, write_groups=True, cutoff=nm2m(20.0),
+                 pz_radius=nm2m(5.0), pz_height=None):
+        self.watch_dir     = watch_dir
+        self.output_dir    = output_dir
+        self.n_workers     = n_workers
+        self.poll_interval = poll_interval
+        self.pattern       = pattern
+        self.plot_dir      = plot_dir
+
+        self.settings = {'output_dir'   : output_dir,
+                         'plot_dir'     : plot_dir,
+                         'write_groups' : write_groups,
+                         'cutoff'       : cutoff,
+                         'pz_radius'    : pz_radius,
+                         'pz_height'    : pz_height}
+
+        results_dir = os.path.join(output_dir, 'results')
+        if not os.path.isdir(results_dir):
+            os.makedirs(results_dir)
+
+        self.ledger_filename = os.path.join(output_dir, 'ledger.json')
+        self.status_filename = os.path.join(output_dir, 'status.json')
+
+        self.ledger = {}
+        if os.path.exists(self.ledger_filename):
+            with open(self.ledger_filename) as ledger_file:
+                self.ledger = json.load(ledger_file)
+
+        self.metrics = {'started'    : time.time(),
+                        'processed'  : 0,
+                        'failed'     : 0,
+                        'skipped'    : 0,
+                        'latency'    : 0.0,
+                        'last_file'  : None,
+                        'last_error' : None}
+
+        # The (size, mtime) of each file at the previous scan, the digest
+        # of each file that has been hashed and the (filename, digest) of
+        # the files that have been submitted or skipped
+        self.__scanned = {}
+        self.__digests = {}
+        self.__handled = set()
+
+        # The digests that are being processed, with their filename, result
+        # and the time they were submitted
+        self.__pending = {}
+
+    def _stable_files(self):
+        '''The files that did not change since the previous scan'''
+        stable = []
+        scanned = {}
+
+        for name in sorted(os.listdir(self.watch_dir)):
+            filename = os.path.join(self.watch_dir, name)
+
+            if not (fnmatch.fnmatch(name, self.pattern) and
+                    os.path.isfile(filename)):
+                continue
+
+            info = os.stat(filename)
+            scanned[filename] = (info.st_size, info.st_mtime)
+
+            if self.__scanned.get(filename) == scanned[filename]:
+                stable.append(filename)
+
+        self.__scanned = scanned
+
+        return stable
+
+    def _digest(self, filename):
+        '''The digest of a file, only hashed again when it changed'''
+        state = self.__scanned[filename]
+
+        if self.__digests.get(filename, (None, None))[0] != state:
+            self.__digests[filename] = (state, file_digest(filename))
+
+        return self.__digests[filename][1]
+
+    def _submit(self, pool):
+        '''Hand the new stable files to the workers'''
+        for filename in self._stable_files():
+            digest = self._digest(filename)
+
+            if (filename, digest) in self.__handled:
+                continue
+            self.__handled.add((filename, digest))
+
+            # A file with content that is done or in progress is skipped,
+            # counted once per file
+            if digest in self.ledger or digest in self.__pending:
+                self.metrics['skipped'] += 1
+                continue
+
+            result = pool.apply_async(_process_log,
+                                      ((filename, digest, self.settings),))
+            self.__pending[digest] = (filename, result, time.time())
+
+    def _collect(self, wait=False):
+        '''Record the files that the workers have finished'''
+        for (digest, (filename, result, t_submit)) in self.__pending.items():
+            if not (wait or result.ready()):
+                continue
+
+            (_, _, results_filename, error) = result.get()
+
+            self.ledger[digest] = {'file'      : filename,
+                                   'processed' : time.time(),
+                                   'status'    : 'failed' if error else 'done',
+                                   'results'   : results_filename,
+                                   'error'     : error}
+            del self.__pending[digest]
+
+            self.metrics['latency']  += time.time() - t_submit
+            self.metrics['last_file'] = filename
+            if error:
+                self.metrics['failed']    += 1
+                self.metrics['last_error'] = error
+            else:
+                self.metrics['processed'] += 1
+
+            _write_json(self.ledger, self.ledger_filename)
+
+    def status(self):
+        '''The state and metrics of the watcher'''
+        status = dict(self.metrics)
+
+        uptime = time.time() - status['started']
+        n_done = status['processed'] + status['failed']
+
+        status.update({
+            'updated'      : time.time(),
+            'uptime'       : uptime,
+            'watch_dir'    : self.watch_dir,
+            'n_workers'    : self.n_workers,
+            'in_progress'  : sorted(filename for (filename, _, _)
+                                    in self.__pending.values()),
+            'n_ledger'     : len(self.ledger),
+            'mean_latency' : status['latency'] / n_done if n_done else None,
+            'per_hour'     : 3600.0 * n_done / uptime if uptime else 0.0})
+
+        return status
+
+    def poll(self, pool):
+        '''Collect the finished files, submit the new ones and write the
+        status'''
+        self._collect()
+        self._submit(pool)
+        _write_json(self.status(), self.status_filename)
+
+    def run(self, max_polls=None):
+        '''Watch the directory until interrupted, or for max_polls scans'''
+        pool = multiprocessing.Pool(self.n_workers, _warm_up,
+                                    (self.plot_dir,))
+
+        n_polls = 0
+        try:
+            while max_polls is None or n_polls < max_polls:
+                self.poll(pool)
+                n_polls += 1
+
+                if max_polls is None or n_polls < max_polls:
+                    time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print 'Stopping, waiting for {} files'.format(len(self.__pending))
+        finally:
+            pool.close()
+            self._collect(wait=True)
+            pool.join()
+
+            _write_json(self.status(), self.status_filename)
+
+
+def main():
+    '''Entry point for this application when it's run as a script'''
+
+    # The directory to watch and optionally the output directory
+    if len(sys.argv) not in (2, 3):
+        print('Provide the directory to watch and optionally the output '
+              'directory!')
+        return 1
+
+    output_dir = sys.argv[2] if len(sys.argv) == 3 else 'output'
+
+    LogWatcher(sys.argv[1], output_dir).run()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+'''Tools to read aircraft data back from an MVIEW xml record'''
+
+import gzip
+import numpy
+import xml.etree.ElementTree as et
+
+from acfttrace import AircraftTrace
+from tools import nm2m, kts2ms, ft2m
+
+# The fields of a logpoint aircraft, in the order they are collected
+LOGPOINT_FIELDS = ['x_nm', 'y_nm', 'hdg_deg', 'spd_kts',
+                   'speed_cmd', 'track_cmd']
+
+# Values of the trace that are not stored in the logpoints
+ND_RANGE = 40
+ND_MODE  = 3
+
+def _open_record(filename):
+    '''Open an xml record, gzip compressed files end with .gz'''
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+
+    return open(filename, 'rb')
+
+def _read_initial_altitudes(scenario_node):
+    '''Get the altitude of each aircraft from the initial traffic'''
+    return dict((acft_node.findtext('ACID'),
+                 ft2m(float(acft_node.findtext('alt_ft'))))
+                for acft_node in scenario_node.iter('aircraft'))
+
+def iter_logpoints(filename):
+    '''Generate (timestamp, traffic) for each logpoint in the file
+
+    The traffic is a list of (callsign, values) with the values of the
+    LOGPOINT_FIELDS in the units of the file. Elements are cleared as soon
+    as they are processed so memory use does not grow with the file size.
+    '''
+    with _open_record(filename) as xml_file:
+        context = et.iterparse(xml_file, events=('start', 'end'))
+
+        # The first event is the start of the record itself
+        (_, root) = next(context)
+
+        for (event, node) in context:
+            if event != 'end' or node.tag != 'logpoint':
+                continue
+
+            timestamp = float(node.findtext('timestamp'))
+            traffic   = [(acft_node.findtext('ACID'),
+                          [float(acft_node.findtext(field))
+                           for field in LOGPOINT_FIELDS])
+                         for acft_node in node.find('traffic')]
+
+            yield (timestamp, traffic)
+
+            root.clear()
+
+def read_initial_altitudes(filename):
+    '''Read the altitude of each aircraft from the scenario of a file'''
+    with _open_record(filename) as xml_file:
+        for (_, node) in et.iterparse(xml_file):
+            if node.tag == 'scenario':
+                return _read_initial_altitudes(node)
+
+    return {}
+
+def read_xml(filename):
+    '''Read an xml record into a list of aircraft traces
+
+    The logpoints do not contain the altitude and calibrated airspeed, the
+    altitude of the initial traffic is used for posz and alt and the
+    airspeed is set to nan.
+    '''
+    altitudes = read_initial_altitudes(filename)
+
+    # Collect the rows per callsign, in the units of the file
+    rows = {}
+
+    for (timestamp, traffic) in iter_logpoints(filename):
+        for (callsign, values) in traffic:
+            rows.setdefault(callsign, []).append([timestamp] + values)
+
+    aircraft = []
+
+    for callsign in sorted(rows):
+        (t, x_nm, y_nm, hdg_deg, spd_kts,
+         speed_cmd, track_cmd) = numpy.array(rows[callsign]).T
+
+        n_points = len(t)
+        altitude = numpy.repeat(altitudes.get(callsign, numpy.nan), n_points)
+
+        data = numpy.column_stack((t,
+                                   nm2m(x_nm),
+                                   nm2m(y_nm),
+                                   altitude,
+                                   altitude,
+                                   numpy.radians(hdg_deg),
+                                   kts2ms(spd_kts),
+                                   numpy.repeat(numpy.nan, n_points),
+                                   numpy.radians(track_cmd),
+                                   kts2ms(speed_cmd),
+                                   numpy.repeat(ND_RANGE, n_points),
+                                   numpy.repeat(ND_MODE, n_points)))
+
+        aircraft.append(AircraftTrace.from_data(callsign, data))
+
+    return aircraft
+
+
+def main():
+    '''Entry point when we run as a script'''
+
+    # Check if we started with the correct arguemnts (exactly one)
+    n_args = len(sys.argv)
+
+    if n_args != 2:
+        print 'Provide the xml file to read!'
+        return 1
+
+    aircraft = read_xml(sys.argv[1])
+
+    for acft in aircraft:
+        print '{}: {} points'.format(acft.callsign, acft.n_points())
+
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -1,9 +1,17 @@
 '''Tools to write aircraft data into an xml format for MVIEW '''
 
+import gzip
+import numpy
 import time
 import xml.etree.ElementTree as et
 
-from tools import m2nm, nm2m, ms2kts, m2ft, rad2deg, BoundingBox
+from tools import m2nm, nm2m, BoundingBox
+
+# Number of decimals of the values in the xml file
+DEFAULT_PRECISION = 6
+
+# Number of logpoints that are converted to text in one go
+LOGPOINT_BLOCK = 1000
 
 exit_waypoint = { 'name':'dummy', 'xcoord':0.0, 'ycoord':0.0 }
 
@@ -39,18 +47,13 @@ def _add_point(parent_node, xcoord, ycoord, name=None):
         et.SubElement(point_node, 'name').text = name
 
 
-def _write_sectors(parent_node, aircraft):
+def _write_sectors(parent_node, boundingbox):
     '''Calculate the sector and write the data'''
 
     sectors_node = et.SubElement(parent_node,  'sectors')
     sector_node  = et.SubElement(sectors_node, 'sector')
     border_node  = et.SubElement(sector_node,  'border_points')
 
-    # Calculate the area used by all planes
-    boundingbox = BoundingBox(aircraft)
-
-    # Add 5NM of padding
-    boundingbox.pad(nm2m(40.0))
     (xmin, xmax, ymin, ymax) = boundingbox.extent()
 
     # Add the four corners of the bounding box (clockwise) as a sector
@@ -67,15 +70,10 @@ def _add_source_sink(parent_node, name, xcoord, ycoord):
 
     _add_point(source_sink_node, xcoord, ycoord, name)
 
-def _write_sources_sinks(parent_node, aircraft):
+def _write_sources_sinks(parent_node, boundingbox):
     '''Calculate the source and sink poits and write them to the document'''
     sources_sinks_node = et.SubElement(parent_node, 'sources_sinks')
 
-    # Calculate the area used by all planes
-    boundingbox = BoundingBox(aircraft)
-
-    # Add 5NM of padding
-    boundingbox.pad(nm2m(40.0))
     (xmin, xmax, ymin, ymax) = boundingbox.extent()
 
     # Put a source top right and sink bottom left
@@ -89,14 +87,47 @@ def _write_sources_sinks(parent_node, aircraft):
     exit_waypoint['ycoord'] = xmin
 
 
-def _write_airspace(parent_node, aircraft):
-    '''Calculate bounding box and write airspace bounds'''
+def _write_airspace(parent_node, aircraft, extent=None):
+    '''Calculate bounding box and write airspace bounds, the extent of the
+    aircraft is calculated if it is not given'''
     airspace_node = et.SubElement(parent_node, 'airspace')
 
-    _write_sectors(airspace_node, aircraft)
-    _write_sources_sinks(airspace_node, aircraft)
+    # Calculate the area used by all planes
+    if extent is None:
+        boundingbox = BoundingBox(aircraft)
+    else:
+        boundingbox = BoundingBox.from_extent(extent)
+
+    # Add 40NM of padding
+    boundingbox.pad(nm2m(40.0))
 
-def _add_initial_aircraft(parent_node, callsign, state):
+    _write_sectors(airspace_node, boundingbox)
+    _write_sources_sinks(airspace_node, boundingbox)
+
+def _convert_traffic(aircraft):
+    '''Convert the fields of all aircraft to the units of the xml file'''
+    return [{'ACID'      : acft.callsign,
+             'x_nm'      : acft.column('posx',    unit='nm'),
+             'y_nm'      : acft.column('posy',    unit='nm'),
+             'alt_ft'    : acft.column('alt',     unit='ft'),
+             'hdg_deg'   : acft.column('psi',     unit='deg'),
+             'spd_kts'   : acft.column('tas',     unit='kts'),
+             'speed_cmd' : acft.column('sel_spd', unit='kts'),
+             'track_cmd' : acft.column('sel_hdg', unit='deg')}
+            for acft in aircraft]
+
+def _format_values(data, precision):
+    '''Format an array of numbers with a fixed number of decimals'''
+    return numpy.char.mod('%.{}f'.format(precision), data)
+
+def _format_traffic(converted, first, last, precision):
+    '''Format the converted fields of all aircraft for a range of indices'''
+    return [dict((name, values if name == 'ACID'
+                  else _format_values(values[first:last], precision))
+                 for (name, values) in fields.items())
+            for fields in converted]
+
+def _add_initial_aircraft(parent_node, text, idx, precision):
     '''Add an initial aircraft block'''
 
     exit_name   = exit_waypoint['name']
@@ -105,89 +136,97 @@ def _add_initial_aircraft(parent_node, callsign, state):
 
     acft_node = et.SubElement(parent_node, 'aircraft')
 
-    et.SubElement(acft_node, 'ACID').text        = callsign
-    et.SubElement(acft_node, 'x_nm').text        = str(m2nm(state.posx))
-    et.SubElement(acft_node, 'y_nm').text        = str(m2nm(state.posy))
-    et.SubElement(acft_node, 'alt_ft').text      = str(m2ft(state.posz))
-    et.SubElement(acft_node, 'hdg_deg').text     = str(rad2deg(state.psi))
+    et.SubElement(acft_node, 'ACID').text        = text['ACID']
+    et.SubElement(acft_node, 'x_nm').text        = text['x_nm'][idx]
+    et.SubElement(acft_node, 'y_nm').text        = text['y_nm'][idx]
+    et.SubElement(acft_node, 'alt_ft').text      = text['alt_ft'][idx]
+    et.SubElement(acft_node, 'hdg_deg').text     = text['hdg_deg'][idx]
     et.SubElement(acft_node, 'gam_deg').text     = '0.0'
-    et.SubElement(acft_node, 'spd_kts').text     = str(ms2kts(state.tas))
+    et.SubElement(acft_node, 'spd_kts').text     = text['spd_kts'][idx]
     et.SubElement(acft_node, 'min_spd_kts').text = str(230.0)
     et.SubElement(acft_node, 'max_spd_kts').text = str( 425.0)
     et.SubElement(acft_node, 'COPX').text        = exit_name
-    et.SubElement(acft_node, 'COPX_x_nm').text   = str(m2nm(exit_xcoord))
-    et.SubElement(acft_node, 'COPX_y_nm').text   = str(m2nm(exit_ycoord))
+    et.SubElement(acft_node, 'COPX_x_nm').text   = str(
+        _format_values(m2nm(exit_xcoord), precision))
+    et.SubElement(acft_node, 'COPX_y_nm').text   = str(
+        _format_values(m2nm(exit_ycoord), precision))
 
 
-def _add_aircraft(parent_node, callsign, state):
+def _add_aircraft(parent_node, text, idx):
     '''Add one aircraft'''
     acft_node = et.SubElement(parent_node, 'aircraft')
 
-    et.SubElement(acft_node, 'ACID').text           = callsign
-    et.SubElement(acft_node, 'x_nm').text           = str(m2nm(state.posx))
-    et.SubElement(acft_node, 'y_nm').text           = str(m2nm(state.posy))
-    et.SubElement(acft_node, 'hdg_deg').text        = str(rad2deg(state.psi))
-    et.SubElement(acft_node, 'spd_kts').text        = str(ms2kts(state.tas))
+    et.SubElement(acft_node, 'ACID').text           = text['ACID']
+    et.SubElement(acft_node, 'x_nm').text           = text['x_nm'][idx]
+    et.SubElement(acft_node, 'y_nm').text           = text['y_nm'][idx]
+    et.SubElement(acft_node, 'hdg_deg').text        = text['hdg_deg'][idx]
+    et.SubElement(acft_node, 'spd_kts').text        = text['spd_kts'][idx]
     et.SubElement(acft_node, 'selected').text       = 'false'
-    et.SubElement(acft_node, 'speed_cmd').text      = str(ms2kts(state.sel_spd))
-    et.SubElement(acft_node, 'track_cmd').text      =str(rad2deg(state.sel_hdg))
+    et.SubElement(acft_node, 'speed_cmd').text      = text['speed_cmd'][idx]
+    et.SubElement(acft_node, 'track_cmd').text      = text['track_cmd'][idx]
     et.SubElement(acft_node, 'conflict').text       = 'false'
     et.SubElement(acft_node, 'PZ_intrusion').text   =  'false'
     et.SubElement(acft_node, 'PZ_intrusion_nm').text= '-1.0'
     et.SubElement(acft_node, 'controlled').text     =  'true'
 
 
-def _add_traffic(parent_node, aircraft_states, initial=False):
+def _add_traffic(parent_node, traffic_text, idx):
     '''Add the traffic data to a log point'''
 
     traffic_node = et.SubElement(parent_node, 'traffic')
 
-    for (callsign, state) in aircraft_states:
-        if initial:
-            _add_initial_aircraft(traffic_node, callsign, state)
-        else:
-            _add_aircraft(traffic_node, callsign, state)
+    for text in traffic_text:
+        _add_aircraft(traffic_node, text, idx)
 
-def _write_initial_traffic(parent_node, aircraft):
+def _write_initial_traffic(parent_node, converted, precision):
     '''Write the initial traffic node'''
-    
-    # Create a list of (callsign,state) tuples
-    aircraft_states = [ (acft.callsign, acft.state(0)) for acft in aircraft ]
 
-    # Use this list to create the traffic element
-    _add_traffic(parent_node, aircraft_states, initial=True)
+    traffic_node = et.SubElement(parent_node, 'traffic')
+
+    # The initial traffic only needs the first state of each aircraft
+    for text in _format_traffic(converted, 0, 1, precision):
+        _add_initial_aircraft(traffic_node, text, 0, precision)
 
-def _write_scenario(parent_node, aircraft):
+def _write_scenario(parent_node, aircraft, converted, precision, extent):
     '''Create a scenario node'''
 
     scenario_node = et.SubElement(parent_node, 'scenario')
 
     _write_file(scenario_node)
     _write_settings(scenario_node)
-    _write_airspace(scenario_node, aircraft)
-    _write_initial_traffic(scenario_node, aircraft)
+    _write_airspace(scenario_node, aircraft, extent)
+    _write_initial_traffic(scenario_node, converted, precision)
 
 
-def _add_log_point(parent_node, timestamp, aircraft_states):
+def _add_log_point(parent_node, timestamp, traffic_text, idx):
     '''Add an individual logpoint to the xml structure'''
     logpoint_node = et.SubElement(parent_node, 'logpoint')
 
-    et.SubElement(logpoint_node, 'timestamp').text = str(timestamp)
+    et.SubElement(logpoint_node, 'timestamp').text = timestamp
     et.SubElement(logpoint_node, 'score').text     = '100.0'
 
-    _add_traffic(logpoint_node, aircraft_states)
+    _add_traffic(logpoint_node, traffic_text, idx)
 
-def _write_log_points(parent_node, aircraft):
-    '''Loop through all the data points and add them to the xml structure'''
-    n_logpoints = aircraft[0].n_points()
+def _iter_log_points(aircraft, converted, precision):
+    '''Generate the (timestamp, traffic_text, idx) of all the data points,
+    the text is formatted in blocks of LOGPOINT_BLOCK logpoints'''
+    t = aircraft[0].column('t')
 
-    for idx in range(n_logpoints):
+    for first in range(0, len(t), LOGPOINT_BLOCK):
+        last = first + LOGPOINT_BLOCK
 
-        timestamp       = str( aircraft[0].t(idx) )
-        aircraft_states = [(acft.callsign, acft.state(idx))
-                           for acft in aircraft]
+        timestamps   = _format_values(t[first:last], precision)
+        traffic_text = _format_traffic(converted, first, last, precision)
 
-        _add_log_point(parent_node, timestamp, aircraft_states)
+        for (idx, timestamp) in enumerate(timestamps):
+            yield (timestamp, traffic_text, idx)
+
+def _write_log_points(parent_node, aircraft, converted, precision):
+    '''Loop through all the data points and add them to the xml structure'''
+    for (timestamp, traffic_text, idx) in _iter_log_points(aircraft,
+                                                           converted,
+                                                           precision):
+        _add_log_point(parent_node, timestamp, traffic_text, idx)
 
 def _write_performance(node):
     '''Add a node with performance data to a node'''
@@ -208,8 +247,13 @@ def _write_performance(node):
     et.SubElement(performance_node, 'midair_collision').text  = 'false'
 
 
-def write_xml(aircraft, filename):
-    '''Build the xml structure and write it to a file'''
+def write_xml(aircraft, filename, precision=DEFAULT_PRECISION, extent=None):
+    '''Build the xml structure and write it to a file, the extent of the
+    aircraft can be given if it is already known'''
+
+    # Convert all the data in one go, the text is formatted with a fixed
+    # number of decimals
+    converted = _convert_traffic(aircraft)
 
     # Create the document root
     root = et.Element('record')
@@ -218,9 +262,9 @@ def write_xml(aircraft, filename):
     print('Creating Preamble')
     _write_date_time(root)
     _write_subject(root)
-    _write_scenario(root, aircraft)
+    _write_scenario(root, aircraft, converted, precision, extent)
     print('Creating Logpoints')
-    _write_log_points(root, aircraft)
+    _write_log_points(root, aircraft, converted, precision)
     print('Creating Performance')
     _write_performance(root)
 
@@ -230,6 +274,55 @@ def write_xml(aircraft, filename):
         xml_file.write(et.tostring(root))
 
 
+def _flush_children(parent_node, xml_file):
+    '''Serialize the children of a node to a file and drop them'''
+    for child in parent_node:
+        xml_file.write(et.tostring(child))
+
+    parent_node.clear()
+
+def write_xml_streaming(aircraft, filename, buffer_size=1024*1024,
+                        precision=DEFAULT_PRECISION, compress=False,
+                        extent=None):
+    '''Write the same xml file as write_xml, but serialize the nodes one at a
+    time so memory use does not grow with the number of logpoints. The file
+    is gzip compressed if compress is set'''
+
+    converted = _convert_traffic(aircraft)
+
+    # Nodes are added to this placeholder and written as soon as they are
+    # complete, only the record tags are written by hand
+    root = et.Element('record')
+
+    print('Writing to: ' + filename)
+    if compress:
+        xml_file = gzip.open(filename, 'wb')
+    else:
+        xml_file = open(filename, 'w', buffer_size)
+
+    with xml_file:
+        xml_file.write('<record>')
+
+        print('Creating Preamble')
+        _write_date_time(root)
+        _write_subject(root)
+        _write_scenario(root, aircraft, converted, precision, extent)
+        _flush_children(root, xml_file)
+
+        print('Creating Logpoints')
+        for (timestamp, traffic_text, idx) in _iter_log_points(aircraft,
+                                                               converted,
+                                                               precision):
+            _add_log_point(root, timestamp, traffic_text, idx)
+            _flush_children(root, xml_file)
+
+        print('Creating Performance')
+        _write_performance(root)
+        _flush_children(root, xml_file)
+
+        xml_file.write('</record>')
+
+
 def main():
     '''Entry point when we run as a script'''
 